@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        if settings.TEMPORARY_IMAGES_JANITOR_INTERVAL:
+            from app.ascii_generators import temporary_images
+            temporary_images.start_janitor(settings.TEMPORARY_IMAGES_JANITOR_INTERVAL)
@@ -0,0 +1,98 @@
+import math
+
+import cv2
+import numpy as np
+from PIL import Image, ImageSequence
+from django.conf import settings
+
+from . import img2ascii_2, workers
+from .enhance import enhance_pixels
+
+FRAMES_PER_TASK = 16  # Frames rendered by one pool's task
+DEFAULT_DURATION = 100  # Milliseconds, if frame has no duration
+
+
+def is_animated(image) -> bool:
+    return getattr(image, 'is_animated', False) and getattr(image, 'n_frames', 1) > 1
+
+
+def get_frames_size(width, height, num_frames, max_size, max_pixels) -> (int, int):
+    """
+    Size of frames that fit into max_size, while all the frames together have no more than max_pixels.
+    :return: Width, height.
+    """
+    ratio = min(max_size[0] / width, max_size[1] / height, math.sqrt(max_pixels / (num_frames * width * height)), 1)
+    return max(int(width * ratio), 1), max(int(height * ratio), 1)
+
+
+def load_frames(image, brightness=None, contrast=None, max_size=(1000, 1000)) -> (np.ndarray, list, bool):
+    """
+    Decode frames within ANIMATION_MAX_FRAMES and ANIMATION_MAX_PIXELS budget. Frame count and size are known
+    from the header, so frames over the budget are never decoded.
+    Decoded frames are converted and composited at full size, as palette frames can't be resampled, and only then
+    downscaled to fit the budget, before enhancement and grayscale conversion.
+    Transparency is composited on white, the same as for uploaded still images.
+    :return: Array of enhanced grayscale frames (num_frames, height, width), durations and if frames were cut.
+    """
+    num_frames = min(image.n_frames, settings.ANIMATION_MAX_FRAMES)
+    size = get_frames_size(image.width, image.height, num_frames, max_size, settings.ANIMATION_MAX_PIXELS)
+    frames = np.empty((num_frames, size[1], size[0]), dtype=np.uint8)
+    durations = []
+    background = Image.new('RGBA', image.size, (255, 255, 255))
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        if index >= num_frames:
+            break
+        durations.append(frame.info.get('duration') or DEFAULT_DURATION)
+        frame = Image.alpha_composite(background, frame.convert('RGBA'))
+        if frame.size != size:
+            frame = frame.resize(size, Image.BILINEAR)
+        pixels = enhance_pixels(np.array(frame), brightness=brightness, contrast=contrast)
+        frames[index] = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+    return frames, durations, image.n_frames > num_frames
+
+
+def _render_frames(frames, start, stop, num_cols, mode):  # executed in pool's worker
+    char_list = img2ascii_2.get_char_list(mode)
+    return [img2ascii_2.cells_to_ascii(img2ascii_2.get_cell_means(frame, num_cols), char_list)
+            for frame in frames[start:stop]]
+
+
+def delta_encode(arts, durations) -> list:
+    """
+    Merge identical consecutive frames, summing their durations, then keep only changed rows of every frame.
+    :return: List of frames as {"duration": ms, "rows": [[row_index, row_text], ...]}, the first frame has all rows.
+    """
+    sequence = []
+    previous_rows = None
+    for art, duration in zip(arts, durations):
+        rows = art.split('\n')
+        if rows == previous_rows:
+            sequence[-1]['duration'] += duration
+            continue
+        changed = [[index, row] for index, row in enumerate(rows)
+                   if previous_rows is None or row != previous_rows[index]]
+        sequence.append({'duration': duration, 'rows': changed})
+        previous_rows = rows
+    return sequence
+
+
+def image_to_ascii_frames(image, num_cols=100, mode='complex', brightness=None, contrast=None,
+                          max_size=(1000, 1000)) -> dict:
+    """
+    Render every frame of animated image with img2ascii_2, spread across the generators pool.
+    :return: Dictionary with "num_cols", "num_rows", "frames" (see delta_encode) and "truncated".
+    """
+    frames, durations, truncated = load_frames(image, brightness=brightness, contrast=contrast, max_size=max_size)
+    num_cols = min(num_cols, frames.shape[2])
+    pool = workers.get_pool()
+    with pool.share(frames) as (shared_frames,):
+        futures = [pool.submit(_render_frames, shared_frames, start, start + FRAMES_PER_TASK, num_cols, mode)
+                   for start in range(0, len(frames), FRAMES_PER_TASK)]
+        arts = [art for future in futures for art in future.result()]
+    sequence = delta_encode(arts, durations)
+    return {
+        'num_cols': num_cols,
+        'num_rows': len(sequence[0]['rows']) - 1,  # Art ends with line break
+        'frames': sequence,
+        'truncated': truncated,
+    }
@@ -1,83 +1,121 @@
-from . import img2ascii_1, img2ascii_2, txt2ascii_1
-import random
-import string
-import numpy as np
-import cv2
+from . import animation, image_probe, img2ascii_1, img2ascii_2, img2ascii_color, txt2ascii_2, workers, temporary_images
+from .image_pipeline import PreparedImage, get_raw_path, get_sidecar_path, save_raw
 from PIL import Image
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 import os
+import json
+import hashlib
+from functools import partial
 from django.conf import settings
-import threading
 from django.core.cache import cache
+from app import caching
 
+IMAGE_MAX_SIZE = (1000, 1000)  # Uploaded images are downscaled to fit into it
+IMAGE_REDUCING_GAP = 2  # Fast reduction stops at this multiple of final size, the rest is high quality resample
+NUM_COLS_MAX = 300  # Used only if DEBUG = False
+NUM_COLS_BATCH_MAX = 16  # Widths rendered in one batch request
+ENHANCE_PERCENT_MAX = 1000  # Brightness and contrast are limited to 10x
+PREVIEW_NUM_COLS_DIVISOR = 4  # Preview of progressive render has 1/4 of columns
+IMAGE_METHODS = ('simple', 'bars', 'complex', 'img2ascii_1')  # Order of arts in response
+PREVIEW_SAVE_PARAMS = {'quality': 85, 'compress_level': 1}  # Fast encoding of JPEG and PNG, other formats ignore it
+SHARE_SAVE_PARAMS = {'quality': 95}  # Shared images are encoded again from raw planes, not from lossy preview
 
-def _calculate_num_cols(path: str, num_cols: int) -> int:
+text_local_cache = caching.LocalCache(settings.TEXT_CACHE_LOCAL_SIZE)
+
+
+def _calculate_num_cols(width: int, num_cols: int) -> int:
     """
-    Recursive function to calculate biggest optimal num_cols for small images.
+    Calculate biggest optimal num_cols for small images.
+    While num_cols <= width, cells are at least 1px wide and 2px high, so rows always fit in image's height
+    and only the width is limiting.
     :return: num_cols.
     """
-    image = Image.open(path)
-    image = np.array(image)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width = image.shape
-    cell_width = width / num_cols
-    cell_height = 2 * cell_width
-    num_rows = int(height / cell_height)
-    if num_cols > width or num_rows > height:
-        num_cols -= 1
-        num_cols = _calculate_num_cols(path, num_cols)
-    return num_cols
+    return min(num_cols, width)
+
+
+def _reduce(image, size):
+    """
+    Decode lazily opened image as close to size as possible, before any conversion is applied.
+    JPEG is decoded with DCT scaling, so full size image is never in memory, other formats are reduced
+    by integer factor right after decoding. The rest is finished with high quality resample.
+    Palette images can't be resampled, they are returned as is and thumbnailed after conversion.
+    :return: Image.
+    """
+    if size == image.size or image.mode in ('1', 'P'):
+        return image
+    image.draft(None, (size[0] * IMAGE_REDUCING_GAP, size[1] * IMAGE_REDUCING_GAP))  # No-op for non-JPEG
+    factor = int(min(image.width / size[0], image.height / size[1]) / IMAGE_REDUCING_GAP)
+    if factor > 1:
+        image = image.reduce(factor)
+    return image.resize(size, Image.LANCZOS)
+
+
+def _get_image_size_cache_key(file_name: str) -> str:
+    return f'image_size_{file_name}'
 
 
-def _generate_unique_image_path(file_extension, r=0, r_max=10):
+def _get_image_size(path: str, file_name: str) -> (int, int):
     """
-    Recursive function that generates random unique file name and path.
-    :return: Full path to file, name with extension.
+    Get size of saved image. It's cached alongside the upload, otherwise only image's header is read.
+    :return: Width, height.
     """
-    # Random name to image
-    name = ''.join(random.choices(string.ascii_lowercase + string.digits, k=15))
-    # Making file name
-    full_name = f'{name}{file_extension}'
-    # Making path
-    full_path = os.path.join(settings.TEMPORARY_IMAGES, full_name)
-    # Checking if it already exist
-    if os.path.exists(full_path):
-        if r >= r_max:
-            return None, None
-        full_path, full_name = _generate_unique_image_path(file_extension, r=r + 1)  # Recursion
-    return full_path, full_name
+    key = _get_image_size_cache_key(file_name)
+    image_size = cache.get(key)
+    if image_size is None:
+        with Image.open(path) as image:
+            image_size = image.size
+        cache.set(key, image_size, settings.CACHE_TIMEOUT_LONG)
+    return image_size
 
 
-def _generator_thread_1_hub(l, args, kwargs, kwargs1, kwargs2):  # custom args/kwargs, others not accepted
-    art1 = img2ascii_2.image_to_ascii(*args, **kwargs, **kwargs1)
-    art2 = img2ascii_2.image_to_ascii(*args, **kwargs, **kwargs2)
-    l[0], l[1] = art1, art2  # mutable list, return is not needed
+def _get_response_cache_key(file_name: str, num_cols: int, brightness: float, contrast: float, color=None) -> str:
+    return '_'.join(
+        (
+            'image_to_ascii_generator',
+            str(file_name),
+            str(num_cols),
+            str(brightness),
+            str(contrast),
+            *((color,) if color else ()),
+        )
+    )
+
 
+def _generator_hub_1(cell_means):  # executed in pool's worker
+    art1 = img2ascii_2.cells_to_ascii(cell_means, img2ascii_2.get_char_list('simple'))
+    art2 = img2ascii_2.cells_to_ascii(cell_means, img2ascii_2.get_char_list('bars'))
+    return [art1, art2]
 
-def _generator_thread_2_hub(l, args, kwargs):
-    art1 = img2ascii_2.image_to_ascii(*args, **kwargs)
-    art2 = img2ascii_1.image_to_ascii(*args, **kwargs)
-    l[0], l[1] = art1, art2
 
+def _generator_hub_2(cell_means, rgb, lut, num_cols):
+    art1 = img2ascii_2.cells_to_ascii(cell_means, img2ascii_2.get_char_list('complex'))
+    art2 = img2ascii_1.rgb_to_ascii(rgb, num_cols, lut)
+    return [art1, art2]
 
-def image_to_ascii_generator(request):
+
+def image_to_ascii_generator(request, single=False):
     """
     Generate ascii from image.
     :param request: Request with data.
     :return: JsonResponse in case of error or dictionary with "file_name", "num_cols", "brightness", "contrast" and "arts".
+        If "num_cols_batch" is given for saved image, dictionary has "renders" with such dictionary for every width.
+        If "preview_method" is given, StreamingHttpResponse with preview and then the full result.
+        If "animate" is given for uploaded animated image, dictionary has "animation" with all the frames.
+    :param single: Ignore "num_cols_batch", "preview_method" and "animate", so the result is always
+        dictionary of single render or JsonResponse with error.
     """
     file_name = request.POST.get('file_name', None)
     num_cols = request.POST.get('num_cols', 90)
     brightness = request.POST.get('brightness', 100)
     contrast = request.POST.get('contrast', 100)
 
-    # Validating user's input
+    # Validating user's input, brightness and contrast are whole percents, every pair of them has its own sidecar
     try:
-        brightness = float(brightness) / 100
+        brightness = min(max(round(float(brightness)), 0), ENHANCE_PERCENT_MAX) / 100
     except:
         brightness = 1.
     try:
-        contrast = float(contrast) / 100
+        contrast = min(max(round(float(contrast)), 0), ENHANCE_PERCENT_MAX) / 100
     except:
         contrast = 1.
     try:
@@ -85,36 +123,41 @@ def image_to_ascii_generator(request):
     except:
         num_cols = 90
     # if we are in DEBUG = False, restrict num_cols to desired number
-    NUM_COLS_MAX = 300
     if not settings.DEBUG and num_cols > NUM_COLS_MAX:
         num_cols = NUM_COLS_MAX
     img = request.FILES.get('img', None)
+    color = request.POST.get('color', None)  # Coloured art in "html" or "ansi" is added to response
+    if color not in img2ascii_color.OUTPUTS:
+        color = None
 
-    # CACHING
-    if file_name:
-        cache_key = '_'.join(
-            (
-                'image_to_ascii_generator',
-                str(file_name),
-                str(num_cols),
-                str(brightness),
-                str(contrast),
-            )
-        )
-        response = cache.get(cache_key)
-        if response:
-            return response
-    else:
-        cache_key = None
-
+    cache_key = None
+    animation_result = None
     if file_name is not None:  # If we are already having image saved - just need to re-generate arts
-        path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
-        if not os.path.exists(path):
+        # Client's name is trusted only if it's a bare name of temporary image, sidecars are written next to it
+        path = temporary_images.resolve(file_name) if temporary_images.is_temporary_name(file_name) else None
+        is_temporary = True
+        if path is None:
             path = os.path.join(settings.MEDIA_ROOT, file_name)
+            is_temporary = False
             if not os.path.exists(path):
                 return JsonResponse({
                     'error': 'This image file does not exist or it was deleted from the server.'
                 }, status=410)
+
+        if is_temporary:
+            temporary_images.touch(file_name)
+
+        # Calculating optimal num_cols for small images, without decoding image
+        width, unused_height = _get_image_size(path, file_name)
+        num_cols = _calculate_num_cols(width, num_cols)
+
+        # Several widths at once, so client can prefetch neighbouring num_cols
+        num_cols_batch = _parse_num_cols_batch(request.POST.get('num_cols_batch', ''), width) if not single else []
+        if num_cols_batch:
+            return _render_image_batch(path, file_name, is_temporary, num_cols_batch, brightness, contrast, color)
+
+        if file_name:
+            cache_key = _get_response_cache_key(file_name, num_cols, brightness, contrast, color)
     elif img is not None:  # If we are uploading new image
         # Getting extension of image
         unused_fn, file_extension = os.path.splitext(img.name)
@@ -125,14 +168,11 @@ def image_to_ascii_generator(request):
             file_extension = '.png'
             converted_to_png = True
 
-        # Generating unique full path to image (None if many recursions for some reason)
-        path, file_name = _generate_unique_image_path(file_extension)
-        if path is None:
-            return JsonResponse({}, status=400)
-
         #  Trying to open user's image (and convert it if needed)
         try:
-            input_img = Image.open(img)
+            # Only the header is read here, uploads over the limits of their format are never decoded
+            input_img, plan = image_probe.probe(img, IMAGE_MAX_SIZE)
+            input_img = _reduce(input_img, plan['size'])
             if converted_to_png:
                 if file_extension == '.bmp':
                     input_img = input_img.convert('RGB')
@@ -140,6 +180,8 @@ def image_to_ascii_generator(request):
                     input_img = input_img.convert("RGBA")
                     bg = Image.new("RGBA", input_img.size)
                     input_img = Image.composite(input_img, bg, input_img)
+        except image_probe.ImageRejected as error:
+            return JsonResponse({'error': error.args}, status=413)
         except Exception as error:
             # print(error)
             return JsonResponse({'error': error.args}, status=400)
@@ -154,54 +196,196 @@ def image_to_ascii_generator(request):
                 image = input_img
         else:
             image = input_img
-        if image.height > 1000 or image.width > 1000:
-            image.thumbnail((1000, 1000), Image.ANTIALIAS)
-        image.save(path, optimize=True, quality=95)
+        if image.width > IMAGE_MAX_SIZE[0] or image.height > IMAGE_MAX_SIZE[1]:
+            image.thumbnail(IMAGE_MAX_SIZE, Image.ANTIALIAS)
+
+        # Image is named by hash of its normalized content, so identical uploads are stored and rendered once
+        file_name = temporary_images.get_content_name(image, file_extension)
+        path = temporary_images.get_path(file_name)
+        temporary_images.add_reference(file_name)
+        # Image file is only a quickly encoded preview for <img>, arts are rendered from its raw planes
+        if temporary_images.save(image, file_name, **PREVIEW_SAVE_PARAMS) or not os.path.exists(get_raw_path(path)):
+            save_raw(get_raw_path(path), image)
+        cache.set(_get_image_size_cache_key(file_name), image.size, settings.CACHE_TIMEOUT_LONG)
+
+        # Image that was displayed to user before is not needed anymore
+        previous_file_name = request.POST.get('previous_file_name', '')
+        if temporary_images.is_content_name(previous_file_name) and previous_file_name != file_name:
+            temporary_images.release_reference(previous_file_name)
+
+        is_temporary = True
+
+        # Calculating optimal num_cols for small images
+        num_cols = _calculate_num_cols(image.width, num_cols)
+
+        # Every frame of animated image is rendered too, still arts are made from the first frame
+        if request.POST.get('animate', False) and not single:
+            img.seek(0)
+            with Image.open(img) as animated_image:
+                if animation.is_animated(animated_image):
+                    animation_result = animation.image_to_ascii_frames(
+                        animated_image, num_cols, brightness=brightness, contrast=contrast, max_size=IMAGE_MAX_SIZE
+                    )
+
+        # The same image could be already rendered for someone else
+        cache_key = _get_response_cache_key(file_name, num_cols, brightness, contrast, color)
     else:
         return JsonResponse({}, status=400)
 
-    # Calculating optimal num_cols for small images
-    num_cols = _calculate_num_cols(path, num_cols)
-
-    # Calling image_to_ascii generators in 2 threads, giving them full path to image and options
-    args = [path]
-    kwargs = {'num_cols': num_cols, 'contrast': contrast, 'brightness': brightness}
-
-    # ---- Thread 1
-    arts_1_list = [None, None]
-    kwargs1 = {'mode': 'simple'}
-    kwargs2 = {'mode': 'bars'}
-    arts_1_thread = threading.Thread(target=_generator_thread_1_hub, daemon=True, args=(
-        arts_1_list, args, kwargs, kwargs1, kwargs2
-    ))
-    arts_1_thread.start()
-
-    # ---- Thread 2
-    arts_2_list = [None, None]
-    arts_2_thread = threading.Thread(target=_generator_thread_2_hub, daemon=True, args=(
-        arts_2_list, args, kwargs
-    ))
-    arts_2_thread.start()
-
-    # Converting some options back to percentage
-    brightness = int(brightness * 100)
-    contrast = int(contrast * 100)
-
-    # ---- Wait Wait for threads to join here
-    arts_1_thread.join()
-    arts_2_thread.join()
+    # Quick preview of chosen method is streamed before the full result, if result is not cached yet
+    preview_method = request.POST.get('preview_method', None) if not single else None
+    if preview_method is not None and animation_result is None and cache_key and caching.get_large(cache_key) is None:
+        try:
+            preview_method = min(max(int(preview_method), 0), len(IMAGE_METHODS) - 1)
+        except ValueError:
+            preview_method = 0
+        return _render_image_progressive(path, file_name, is_temporary, num_cols, brightness, contrast, color,
+                                         preview_method, cache_key)
+
+    render = partial(_render_image, path, file_name, is_temporary, num_cols, brightness, contrast, color)
+
+    # CACHING, identical requests arriving at the same time are rendered only once
+    if cache_key:
+        response = caching.get_or_set_single_flight(cache_key, render, settings.CACHE_TIMEOUT_NORMAL)
+    else:
+        response = render()
+    if animation_result is not None:
+        response = {**response, 'animation': animation_result}
+    return response
+
+
+def _parse_num_cols_batch(value: str, width: int) -> list:
+    """
+    Parse list of num_cols, either comma-separated ("60,90,120") or inclusive range with step ("60:120:10").
+    Values are validated like single num_cols and limited to NUM_COLS_BATCH_MAX unique widths.
+    :return: List of num_cols, empty if value is empty or invalid.
+    """
+    try:
+        if ':' in value:
+            start, stop, step = (int(part) for part in value.split(':'))
+            values = _clamp_num_cols_range(start, stop, step, width) if step > 0 else []
+        else:
+            values = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        return []
+    num_cols_batch = []
+    for num_cols in values:
+        if num_cols < 1:
+            continue
+        if not settings.DEBUG and num_cols > NUM_COLS_MAX:
+            num_cols = NUM_COLS_MAX
+        num_cols = _calculate_num_cols(width, num_cols)
+        if num_cols not in num_cols_batch:
+            num_cols_batch.append(num_cols)
+            if len(num_cols_batch) >= NUM_COLS_BATCH_MAX:
+                break
+    return num_cols_batch
+
+
+def _clamp_num_cols_range(start: int, stop: int, step: int, width: int) -> range:
+    """
+    Inclusive range of num_cols without values that would be skipped or limited to the same num_cols,
+    so huge ranges are not walked.
+    :return: Range starting with its first positive value and ending with its first value over the biggest num_cols.
+    """
+    max_num_cols = width if settings.DEBUG else min(width, NUM_COLS_MAX)
+    if start < 1:
+        start += -(-(1 - start) // step) * step
+    return range(start, min(stop, max_num_cols + step) + 1, step)
+
+
+def _open_prepared_image(path, is_temporary, brightness, contrast) -> PreparedImage:
+    # Decoding, enhancing and converting image to grayscale only once for all the generators.
+    # Temporary images are never decoded again: their raw planes are memory-mapped, integral image
+    # is kept in sidecar, so re-renders with same brightness and contrast don't calculate it for img2ascii_2 arts.
+    if not is_temporary:
+        return PreparedImage.open(path, brightness=brightness, contrast=contrast)
+    return PreparedImage.open(path, brightness=brightness, contrast=contrast,
+                              sidecar_path=get_sidecar_path(path, brightness, contrast), raw_path=get_raw_path(path))
+
+
+def _render_image_batch(path, file_name, is_temporary, num_cols_batch, brightness, contrast, color=None) -> dict:
+    """
+    Render all the arts of saved image for every num_cols, image is decoded once for all of them.
+    Every width is cached separately, so it's also served to single requests.
+    :return: Dictionary with "file_name", "brightness", "contrast" and "renders" - list of single responses.
+    """
+    prepared_image = _open_prepared_image(path, is_temporary, brightness, contrast)
+    renders = []
+    for num_cols in num_cols_batch:
+        render = partial(_render_image, path, file_name, is_temporary, num_cols, brightness, contrast, color,
+                         prepared_image=prepared_image)
+        cache_key = _get_response_cache_key(file_name, num_cols, brightness, contrast, color)
+        renders.append(caching.get_or_set_single_flight(cache_key, render, settings.CACHE_TIMEOUT_NORMAL))
+    return {
+        'file_name': file_name,
+        'brightness': int(brightness * 100),
+        'contrast': int(contrast * 100),
+        'renders': renders,
+    }
+
+
+def _render_image_progressive(path, file_name, is_temporary, num_cols, brightness, contrast, color,
+                              preview_method, cache_key) -> StreamingHttpResponse:
+    """
+    Render saved image in two phases, streamed as JSON lines. The first line is {"preview": {"method", "num_cols",
+    "art"}} - art of chosen method only, with 1/4 of columns. The second line is the full response.
+    Both phases share one PreparedImage, so preview doesn't decode the image again.
+    :return: StreamingHttpResponse.
+    """
+    prepared_image = _open_prepared_image(path, is_temporary, brightness, contrast)
+
+    def stream():
+        preview_num_cols = max(num_cols // PREVIEW_NUM_COLS_DIVISOR, 1)
+        mode = IMAGE_METHODS[preview_method]
+        if mode == 'img2ascii_1':
+            art = prepared_image.to_ascii_1(preview_num_cols)
+        else:
+            art = prepared_image.to_ascii(preview_num_cols, mode)
+        yield json.dumps({'preview': {'method': preview_method, 'num_cols': preview_num_cols, 'art': art}}) + '\n'
+
+        render = partial(_render_image, path, file_name, is_temporary, num_cols, brightness, contrast, color,
+                         prepared_image=prepared_image)
+        yield json.dumps(caching.get_or_set_single_flight(cache_key, render, settings.CACHE_TIMEOUT_NORMAL)) + '\n'
+
+    return StreamingHttpResponse(stream(), content_type='application/x-ndjson')
+
+
+def _render_image(path, file_name, is_temporary, num_cols, brightness, contrast, color=None,
+                  prepared_image=None) -> dict:
+    """
+    Render all the arts of saved image.
+    :param color: "html" or "ansi" to add coloured art of "complex" mode as "color_art".
+    :param prepared_image: PreparedImage shared by several renders, opened if not given.
+    :return: Dictionary with "file_name", "num_cols", "brightness", "contrast" and "arts".
+    """
+    if prepared_image is None:
+        prepared_image = _open_prepared_image(path, is_temporary, brightness, contrast)
+
+    # Calculating cell luminance grid once, all the character ramps are sharing it
+    cell_means = prepared_image.cell_means(num_cols)
+
+    # Calling image_to_ascii generators in persistent pool, giving them shared grids and options
+    pool = workers.get_pool()
+    with pool.share(cell_means, prepared_image.rgb) as (shared_cell_means, shared_rgb):
+        arts_1_future = pool.submit(_generator_hub_1, shared_cell_means)
+        arts_2_future = pool.submit(_generator_hub_2, shared_cell_means, shared_rgb, prepared_image.lut_1, num_cols)
+        # ---- Wait for workers here
+        arts_1_list = arts_1_future.result()
+        arts_2_list = arts_2_future.result()
 
     response = {
         'file_name': file_name,
         'num_cols': num_cols,
-        'brightness': brightness,
-        'contrast': contrast,
+        # Converting some options back to percentage
+        'brightness': int(brightness * 100),
+        'contrast': int(contrast * 100),
         'arts': [*arts_1_list, *arts_2_list]
     }
 
-    # CACHING
-    if cache_key:
-        cache.set(cache_key, response, settings.CACHE_TIMEOUT_NORMAL)
+    # Coloured art is using the same cells as monochrome arts, luminance and colours are averaged in one pass
+    if color:
+        response['color_art'] = prepared_image.to_color_ascii(num_cols, output=color)
 
     return response
 
@@ -212,7 +396,8 @@ def text_to_ascii_generator(request) -> list:
     :param request: Request with data.
     :return: List, containing arts in format [font, generated_ascii].
     """
-    if not request.POST.get('multiple_strings', False):  # If input is in single-line mode
+    multiple_strings = bool(request.POST.get('multiple_strings', False))
+    if not multiple_strings:  # If input is in single-line mode
         input_text = request.POST.get('txt', '')
         if len(input_text) == 0:
             input_text = 'Hello World'
@@ -222,9 +407,31 @@ def text_to_ascii_generator(request) -> list:
         if len(input_text) == 0:
             input_text = 'Hello\nWorld'
         lines = 1 + input_text.count('\n')
+
+    # CACHING, identical requests arriving at the same time are rendered only once.
+    # Popular texts (like default ones) are served from memory of this process.
+    input_text = txt2ascii_2.normalize(input_text)
+    render = partial(_render_text, input_text, lines)
+    return caching.get_or_set_single_flight(_get_text_cache_key(input_text, lines), render,
+                                            settings.CACHE_TIMEOUT_NORMAL, local_cache=text_local_cache)
+
+
+def _get_text_cache_key(input_text: str, lines: int) -> str:
+    # Arts depend on input mode only by amount of lines, that filters out small arts
+    key = f'{lines}\n{txt2ascii_2.get_font_set_version()}\n{input_text}'
+    return f'text_to_ascii_generator_{hashlib.sha256(key.encode("utf-8", "surrogatepass")).hexdigest()}'
+
+
+def _render_text(input_text: str, lines: int) -> list:
+    """
+    Render input text with every font, which arts are not too small.
+    :return: List, containing arts in format [font, generated_ascii].
+    """
     results = []
-    for font in txt2ascii_1.FONT_NAMES:
-        generated_ascii = txt2ascii_1.text2art(text=input_text, font=font)
+    # Fonts which arts are too small for sure are not rendered, it's known from their metrics.
+    # Fonts without glyphs for characters of text are not rendered too, fonts with only some of them go last.
+    fonts = txt2ascii_2.rank_fonts(input_text, txt2ascii_2.select_fonts(input_text, 3 * lines + 1))
+    for font, generated_ascii in txt2ascii_2.text2arts(input_text, fonts):  # All the fonts in a single pass
         if len(generated_ascii.split('\n')) > (3 * lines):  # Do not append very small arts
             cut = 0
             for line in generated_ascii[::-1].split('\n'):  # Remove some empty lines at the end of arts
@@ -0,0 +1,57 @@
+import numpy as np
+from PIL import Image
+
+
+def _blend(degenerate, values, factor):
+    # Same float32 arithmetic, truncation and clipping as PIL's Image.blend, which ImageEnhance is using
+    temp = np.float32(degenerate) + np.float32(factor) * (values.astype(np.int32) - degenerate).astype(np.float32)
+    return np.clip(temp, 0, 255).astype(np.uint8)
+
+
+def get_enhance_lut(mean, brightness=None, contrast=None):
+    """
+    256-entry lookup table applying ImageEnhance.Contrast and then ImageEnhance.Brightness formulas at once.
+    :param mean: Mean value of grayscale plane, ImageEnhance.Contrast is blending with it.
+    """
+    lut = np.arange(256, dtype=np.uint8)
+    if contrast is not None:
+        lut = _blend(int(mean + 0.5), lut, contrast)
+    if brightness is not None:
+        lut = _blend(0, lut, brightness)
+    return lut
+
+
+def enhance_plane(plane, brightness=None, contrast=None):
+    """
+    Apply contrast and brightness to uint8 grayscale plane in a single pass.
+    :return: New enhanced plane, or the same plane if there's nothing to apply.
+    """
+    if brightness is None and contrast is None:
+        return plane
+    mean = plane.mean() if contrast is not None and plane.size else 0
+    return get_enhance_lut(mean, brightness=brightness, contrast=contrast)[plane]
+
+
+def get_contrast_mean(pixels) -> float:
+    """
+    Mean that ImageEnhance.Contrast is blending with: mean of PIL's "L" conversion of the colour image,
+    it weights channels differently than cv2's grayscale.
+    :param pixels: Array (height, width, 3 or 4) of uint8, RGB or RGBA.
+    """
+    if not pixels.size:
+        return 0
+    return np.array(Image.fromarray(np.ascontiguousarray(pixels)).convert('L')).mean()
+
+
+def enhance_pixels(pixels, brightness=None, contrast=None, mean=None):
+    """
+    Apply contrast and brightness to every channel of colour image in a single pass, exactly as ImageEnhance does.
+    :param pixels: Array (height, width, channels) of uint8, RGB or RGBA.
+    :param mean: Mean of get_contrast_mean(), if it's already known.
+    :return: New enhanced pixels, or the same pixels if there's nothing to apply.
+    """
+    if brightness is None and contrast is None:
+        return pixels
+    if mean is None:
+        mean = get_contrast_mean(pixels) if contrast is not None else 0
+    return get_enhance_lut(mean, brightness=brightness, contrast=contrast)[pixels]
@@ -0,0 +1,87 @@
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b'ASCIIFNT'
+FORMAT_VERSION = 3  # Packs of other versions must be built again
+HEADER = struct.Struct('<8sII')  # Magic, format version, size of index
+GLYPH_SEPARATOR = '\0'
+
+
+class FontPackError(Exception):
+    pass
+
+
+def _encode_font(glyphs: dict) -> bytes:
+    # Every glyph is its character followed by its rows, there's no NUL in glyphs
+    return GLYPH_SEPARATOR.join(char + '\n'.join(rows) for char, rows in glyphs.items()).encode('utf-8')
+
+
+def _decode_font(data: bytes) -> dict:
+    if not data:
+        return {}
+    return {item[0]: tuple(item[1:].split('\n')) for item in data.decode('utf-8').split(GLYPH_SEPARATOR)}
+
+
+def write(path: str, fonts: dict, version: str):
+    """
+    Write compiled fonts into one file: header, JSON index with fonts' metrics catalog and offsets,
+    and blob of glyph rows.
+    File is replaced atomically, so running processes keep their memory-mapped old pack.
+    :param fonts: Dictionary {font name: compiled font}, see txt2ascii_2.compile_font().
+    :param version: Version of font set.
+    """
+    blob = []
+    index = {'version': version, 'fonts': {}}
+    offset = 0
+    for font_name, font in fonts.items():
+        data = _encode_font(font['glyphs'])
+        index['fonts'][font_name] = {
+            **{key: value for key, value in font.items() if key != 'glyphs'},
+            'offset': offset,
+            'size': len(data),
+        }
+        blob.append(data)
+        offset += len(data)
+    index['rendered_chars'] = ''.join(sorted({char for font in fonts.values() for char in font['glyphs']}))
+    index_data = json.dumps(index, ensure_ascii=False).encode('utf-8')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index_data)))
+        file.write(index_data)
+        for data in blob:
+            file.write(data)
+    os.replace(temporary_path, path)
+
+
+class FontPack:
+    """
+    Font pack memory-mapped read-only, so its pages are shared by all the processes through the OS page cache.
+    Only the index is parsed on open, glyphs of font are decoded when font is loaded.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, index_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise FontPackError(f'{path} is not a font pack of version {FORMAT_VERSION}.')
+        index = json.loads(self._mmap[HEADER.size:HEADER.size + index_size].decode('utf-8'))
+        self._fonts = index['fonts']
+        self._blob_offset = HEADER.size + index_size
+        self.version = index['version']
+        self.rendered_chars = frozenset(index['rendered_chars'])
+        self.names = list(self._fonts)
+        self.catalog = {font_name: {key: value for key, value in font.items() if key not in ('offset', 'size')}
+                        for font_name, font in self._fonts.items()}
+
+    def load(self, font_name: str) -> dict:
+        """
+        :return: Compiled font, see txt2ascii_2.compile_font().
+        """
+        font = dict(self._fonts[font_name])
+        start = self._blob_offset + font.pop('offset')
+        font['glyphs'] = _decode_font(self._mmap[start:start + font.pop('size')])
+        return font
@@ -0,0 +1,259 @@
+import glob
+import io
+import os
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import img2ascii_1, img2ascii_2, img2ascii_color
+from .enhance import enhance_pixels, get_contrast_mean, get_enhance_lut
+
+SIDECAR_SUFFIX = '.sat.npy'
+RAW_SUFFIX = '.raw.npy'
+TEMPORARY_FILE_PREFIX = '.tmp_'  # Files being written, hidden from everyone but janitor
+LOSSY_FORMATS = ('JPEG', 'WEBP')
+
+
+def get_sidecar_path(path, brightness=None, contrast=None) -> str:
+    """
+    Path to integral image sidecar of enhanced grayscale, next to the image itself.
+    Every brightness/contrast pair has its own sidecar, so changing them doesn't invalidate others.
+    """
+    return f'{path}.{brightness}_{contrast}{SIDECAR_SUFFIX}'
+
+
+def get_raw_path(path) -> str:
+    """
+    Path to raw planes of image, next to the image itself.
+    """
+    return f'{path}{RAW_SUFFIX}'
+
+
+def remove_sidecars(path) -> (int, int):
+    """
+    Remove all the sidecars and raw planes of image.
+    :return: Amount of removed files and their size in bytes.
+    """
+    removed, removed_bytes = 0, 0
+    for sidecar_path in [*glob.glob(f'{glob.escape(path)}.*{SIDECAR_SUFFIX}'), get_raw_path(path)]:
+        try:
+            size = os.path.getsize(sidecar_path)
+            os.remove(sidecar_path)
+        except FileNotFoundError:  # Removed by someone else in the meantime
+            continue
+        removed += 1
+        removed_bytes += size
+    return removed, removed_bytes
+
+
+def _save_array(path, array):
+    # Every thread writes its own hidden file, concurrent writers of the same array just replace it in turn
+    directory, file_name = os.path.split(path)
+    temporary_path = os.path.join(directory,
+                                  f'{TEMPORARY_FILE_PREFIX}{os.getpid()}_{threading.get_ident()}_{file_name}')
+    try:
+        with open(temporary_path, 'wb') as file:
+            np.save(file, array)
+    except FileNotFoundError:  # Image was removed in the meantime, array is only not stored
+        return
+    os.replace(temporary_path, path)  # Atomic, concurrent readers see either nothing or full file
+
+
+def _save_integral(sidecar_path, integral):
+    # Image sizes are limited, so sums almost always fit into uint32, which halves the sidecar
+    if integral[-1, -1] <= np.iinfo(np.uint32).max:
+        integral = integral.astype(np.uint32)
+    _save_array(sidecar_path, integral)
+
+
+def get_raw_planes(image) -> np.ndarray:
+    """
+    Not enhanced planes of img2ascii_color.get_planes(): grayscale of img2ascii_2 and RGB channels.
+    :return: Array (height, width, 4) of uint8.
+    """
+    return img2ascii_color.get_planes(np.array(image.convert('RGB')))
+
+
+def save_raw(raw_path, image) -> np.ndarray:
+    """
+    Store raw planes of image as .npy, which is loaded by memory-mapping, without decoding anything.
+    :return: Raw planes.
+    """
+    raw = get_raw_planes(image)
+    _save_array(raw_path, raw)
+    return raw
+
+
+def encode_raw(raw_path, image_format, **params) -> bytes:
+    """
+    Encode RGB channels of raw planes again, e.g. with higher quality than the image file has.
+    :param params: Parameters of Image.save().
+    :return: Encoded image.
+    """
+    raw = np.load(raw_path, mmap_mode='r')
+    file = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(raw[:, :, 1:]), mode='RGB').save(file, image_format, **params)
+    return file.getvalue()
+
+
+class PreparedImage:
+    """
+    Image that is decoded, converted to grayscale and enhanced only once,
+    so every art generator can share it instead of opening the file by itself.
+    Brightness and contrast are applied to grayscale planes through a lookup table, never to full colour image.
+
+    If sidecar_path is given, integral image is memory-mapped from it (or saved to it after calculation),
+    then img2ascii_2 arts at any num_cols are calculated without decoding the image at all.
+    If raw_path is given, the rest of the arts are made from raw planes memory-mapped from it (or saved to it
+    after the image is decoded), instead of the image file.
+    """
+
+    def __init__(self, path, brightness=None, contrast=None, sidecar_path=None, raw_path=None):
+        self.path = path
+        self.brightness = brightness
+        self.contrast = contrast
+        self.sidecar_path = sidecar_path
+        self.raw_path = raw_path
+        self._image = None
+        self._raw = None
+        self._gray = None
+        self._rgb = None
+        self._lut_1 = None
+        self._contrast_mean = None
+        self._integral = None
+        self._cell_means = {}
+        self._color_integral = None
+        self._color_cell_means = {}
+
+    @classmethod
+    def open(cls, path, brightness=None, contrast=None, sidecar_path=None, raw_path=None):
+        return cls(path, brightness=brightness, contrast=contrast, sidecar_path=sidecar_path, raw_path=raw_path)
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.open(self.path)
+        return self._image
+
+    @property
+    def raw(self):
+        """
+        Not enhanced grayscale of img2ascii_2 and RGB channels, see get_raw_planes().
+        """
+        if self._raw is None:
+            if self.raw_path and os.path.exists(self.raw_path):
+                self._raw = np.load(self.raw_path, mmap_mode='r')
+            elif self.raw_path:
+                self._raw = save_raw(self.raw_path, self.image)
+            else:
+                self._raw = get_raw_planes(self.image)
+        return self._raw
+
+    @property
+    def gray(self):
+        """
+        Enhanced grayscale plane of img2ascii_2.
+        """
+        if self._gray is None:
+            if self.brightness is None and self.contrast is None:
+                self._gray = np.array(self.raw[:, :, 0])
+            else:
+                # RGB channels are enhanced before conversion, as ImageEnhance is applied to colour image
+                pixels = enhance_pixels(self.rgb, brightness=self.brightness, contrast=self.contrast,
+                                        mean=self.contrast_mean)
+                self._gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def rgb(self):
+        """
+        Not enhanced RGB channels of img2ascii_1, it's resizing them before PIL's "L" conversion.
+        """
+        if self._rgb is None:
+            self._rgb = np.ascontiguousarray(self.raw[:, :, 1:])
+        return self._rgb
+
+    @property
+    def contrast_mean(self):
+        """
+        Mean that contrast of every art is blending with, see enhance.get_contrast_mean(). 0 without contrast.
+        """
+        if self._contrast_mean is None:
+            self._contrast_mean = get_contrast_mean(self.rgb) if self.contrast is not None else 0
+        return self._contrast_mean
+
+    @property
+    def lut_1(self):
+        """
+        Brightness and contrast lookup table of img2ascii_1, see img2ascii_1.get_lut().
+        """
+        if self._lut_1 is None and (self.brightness is not None or self.contrast is not None):
+            self._lut_1 = get_enhance_lut(self.contrast_mean, brightness=self.brightness, contrast=self.contrast)
+        return self._lut_1
+
+    @property
+    def integral(self):
+        if self._integral is None:
+            if self.sidecar_path and os.path.exists(self.sidecar_path):
+                self._integral = np.load(self.sidecar_path, mmap_mode='r')
+            else:
+                self._integral = img2ascii_2.get_integral_image(self.gray)
+                if self.sidecar_path:
+                    _save_integral(self.sidecar_path, self._integral)
+        return self._integral
+
+    @property
+    def height(self):
+        return self.integral.shape[0] - 1
+
+    @property
+    def width(self):
+        return self.integral.shape[1] - 1
+
+    def cell_means(self, num_cols):
+        """
+        Cell luminance grid for given geometry, calculated once and shared by every character ramp.
+        """
+        if num_cols not in self._cell_means:
+            self._cell_means[num_cols] = img2ascii_2.get_cell_means_from_integral(self.integral, num_cols)
+        return self._cell_means[num_cols]
+
+    @property
+    def color_integral(self):
+        """
+        Integral image of luminance and RGB channels, summed in one pass.
+        """
+        if self._color_integral is None:
+            planes = img2ascii_color.enhance_planes(self.raw, brightness=self.brightness, contrast=self.contrast,
+                                                    mean=self.contrast_mean)
+            self._color_integral = img2ascii_2.get_integral_image(planes)
+        return self._color_integral
+
+    def color_cell_means(self, num_cols):
+        """
+        Cell luminance and RGB grid, with the same geometry as cell_means().
+        """
+        if num_cols not in self._color_cell_means:
+            self._color_cell_means[num_cols] = img2ascii_2.get_cell_means_from_integral(self.color_integral, num_cols)
+        return self._color_cell_means[num_cols]
+
+    def to_ascii(self, num_cols, mode='complex') -> str:
+        """
+        Art of img2ascii_2 for given mode ("simple", "bars" or "complex").
+        """
+        return img2ascii_2.cells_to_ascii(self.cell_means(num_cols), img2ascii_2.get_char_list(mode))
+
+    def to_ascii_1(self, num_cols) -> str:
+        """
+        Art of img2ascii_1.
+        """
+        return img2ascii_1.rgb_to_ascii(self.rgb, num_cols, self.lut_1)
+
+    def to_color_ascii(self, num_cols, mode='complex', output=img2ascii_color.OUTPUT_HTML) -> str:
+        """
+        Coloured art of img2ascii_2 for given mode, as HTML or ANSI.
+        """
+        return img2ascii_color.cells_to_color_ascii(self.color_cell_means(num_cols), img2ascii_2.get_char_list(mode),
+                                                    output)
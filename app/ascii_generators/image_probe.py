@@ -0,0 +1,100 @@
+import threading
+
+from PIL import Image
+from django.conf import settings
+
+DEFAULT_LIMITS = 'default'
+
+_lock = threading.Lock()
+_metrics = {
+    'probed': 0,
+    'downscale_planned': 0,
+    'rejected': 0,
+    'rejected_bytes': 0,
+    'rejected_pixels': 0,
+}
+
+
+class ImageRejected(Exception):
+    """
+    Upload is over the limits of its format, it was not decoded.
+    """
+
+
+def _count(**counters):
+    with _lock:
+        for name, value in counters.items():
+            _metrics[name] += value
+
+
+def get_limits(image_format) -> dict:
+    """
+    Limits of format from IMAGE_PROBE_LIMITS, missing ones are taken from the default limits.
+    :return: Dictionary with "max_bytes", "max_pixels" and "max_frames", 0 for no limit.
+    """
+    limits = settings.IMAGE_PROBE_LIMITS
+    return {**limits[DEFAULT_LIMITS], **limits.get(image_format, {})}
+
+
+def get_planned_size(width, height, max_size) -> (int, int):
+    """
+    Size of image downscaled to fit into max_size, images that fit already keep their size.
+    :return: Width, height.
+    """
+    if width <= max_size[0] and height <= max_size[1]:
+        return width, height
+    ratio = min(max_size[0] / width, max_size[1] / height)
+    return max(round(width * ratio), 1), max(round(height * ratio), 1)
+
+
+def _reject(message, num_bytes, num_pixels):
+    _count(rejected=1, rejected_bytes=num_bytes, rejected_pixels=num_pixels)
+    raise ImageRejected(message)
+
+
+def probe(img, max_size) -> (Image.Image, dict):
+    """
+    Open uploaded image reading only its header, and check its size against limits of its format
+    before any pixel data is decoded.
+    :param img: Uploaded file.
+    :param max_size: Size that image will be downscaled to fit into.
+    :return: Lazily opened image and plan with "format", "mode", "width", "height", "frames"
+        and planned "size" after downscale.
+    :raise ImageRejected: If image is over the limits or its header is too big to be parsed safely.
+    """
+    _count(probed=1)
+    num_bytes = img.size
+    try:
+        image = Image.open(img)
+    except Image.DecompressionBombError as error:  # Pillow's own hard limit
+        _reject(str(error), num_bytes, 0)
+    limits = get_limits(image.format)
+    num_pixels = image.width * image.height
+    # Frame count of multi-frame formats is known from the header or by skipping over frames' data
+    num_frames = getattr(image, 'n_frames', 1)
+    if limits['max_bytes'] and num_bytes > limits['max_bytes']:
+        _reject(f'{image.format} image is bigger than {limits["max_bytes"]} bytes.', num_bytes, num_pixels)
+    if limits['max_pixels'] and num_pixels > limits['max_pixels']:
+        _reject(f'{image.format} image has more than {limits["max_pixels"]} pixels.', num_bytes, num_pixels)
+    if limits['max_frames'] and num_frames > limits['max_frames']:
+        _reject(f'{image.format} image has more than {limits["max_frames"]} frames.', num_bytes, num_pixels)
+    size = get_planned_size(image.width, image.height, max_size)
+    if size != image.size:
+        _count(downscale_planned=1)
+    return image, {
+        'format': image.format,
+        'mode': image.mode,
+        'width': image.width,
+        'height': image.height,
+        'frames': num_frames,
+        'size': size,
+    }
+
+
+def get_metrics() -> dict:
+    """
+    Counters of this process, rejected bytes are sizes of rejected uploads, rejected pixels are their pixels
+    that were never decoded.
+    """
+    with _lock:
+        return dict(_metrics)
@@ -1,5 +1,7 @@
+import numpy as np
 from PIL import Image
-from PIL import ImageEnhance
+
+from .enhance import get_enhance_lut
 
 ASCII_CHARS = ['.', ',', ':', ';', '+', '*', '?', '%', 'S', '#', '@']
 ASCII_CHARS = ASCII_CHARS[::-1]
@@ -19,22 +21,44 @@ def grayscalify(image):
 
 
 def modify(image, buckets=25):
-    initial_pixels = list(image.getdata())
-    new_pixels = [ASCII_CHARS[pixel_value // buckets] for pixel_value in initial_pixels]
-    return ''.join(new_pixels)
+    # Raw L-mode buffer is mapped to characters at once, without python object per pixel
+    lookup_table = bytes(ord(ASCII_CHARS[pixel_value // buckets]) for pixel_value in range(256))
+    return image.tobytes().translate(lookup_table)
 
 
-def do(image, new_width):
+def do(image, new_width, lut=None):
     image = resize(image, new_width)
     image = grayscalify(image)
+    if lut is not None:
+        image = image.point(lut.tolist())
+
+    pixels = np.frombuffer(modify(image), dtype=np.uint8).reshape(image.height, image.width)
+
+    # Construct the image from the character buffer, new lines are written through strided view
+    new_image = np.empty((image.height, image.width + 1), dtype=np.uint8)
+    new_image[:, :-1] = pixels
+    new_image[:, -1] = ord('\n')
+
+    return new_image.tobytes()[:-1].decode('ascii')
+
 
-    pixels = modify(image)
-    len_pixels = len(pixels)
+def get_lut(image, brightness=None, contrast=None):
+    """
+    Lookup table of brightness and contrast, applied to grayscale after the image is resized.
+    Contrast is blending with the mean of full size grayscale, as ImageEnhance.Contrast does.
+    :return: 256-entry lookup table, or None if there's nothing to apply.
+    """
+    if brightness is None and contrast is None:
+        return None
+    mean = np.array(grayscalify(image)).mean() if contrast is not None else 0
+    return get_enhance_lut(mean, brightness=brightness, contrast=contrast)
 
-    # Construct the image from the character list
-    new_image = [pixels[index:index + new_width] for index in range(0, len_pixels, new_width)]
 
-    return '\n'.join(new_image)
+def rgb_to_ascii(rgb, num_cols, lut=None):
+    """
+    Art of RGB pixels, resized before conversion to grayscale, like the image itself.
+    """
+    return do(Image.fromarray(rgb, mode='RGB'), num_cols, lut)
 
 
 def image_to_ascii(path, num_cols=100, brightness=None, contrast=None) -> str:
@@ -43,9 +67,4 @@ def image_to_ascii(path, num_cols=100, brightness=None, contrast=None) -> str:
         image = Image.open(path)
     except Exception:
         return
-    if contrast is not None:
-        image = ImageEnhance.Contrast(image).enhance(contrast)
-    if brightness is not None:
-        image = ImageEnhance.Brightness(image).enhance(brightness)
-    image = do(image, num_cols)
-    return image
+    return do(image, num_cols, get_lut(image, brightness=brightness, contrast=contrast))
@@ -1,38 +1,78 @@
 import cv2
 import numpy as np
 from PIL import Image
-from PIL import ImageEnhance
+
+from .enhance import enhance_pixels
+
+CHAR_LISTS = {
+    'simple': '@%#*+=-:. ',
+    'bars': '█▓▒░',
+    'complex': "$@B%8&WM#*zcvunxrjft/\|()1{}[]?-_+~<>i!lI;;::,,,\"\"\"^^^`````'''''.......     ",
+}
+
+
+def get_char_list(mode):
+    return CHAR_LISTS.get(mode, CHAR_LISTS['complex'])
 
 
 def get_sizes(image, num_cols):
-    height, width = image.shape
+    height, width = image.shape[:2]
     cell_width = width / num_cols
     cell_height = 2 * cell_width
     num_rows = int(height / cell_height)
     return height, width, cell_width, cell_height, num_rows
 
 
+def get_cell_bounds(length, cell_size, num_cells):
+    # Same int() truncation of float cell edges as the old per-cell slicing
+    starts = (np.arange(num_cells) * cell_size).astype(np.int64)
+    ends = np.minimum((np.arange(1, num_cells + 1) * cell_size).astype(np.int64), length)
+    return starts, ends
+
+
+def get_integral_image(image):
+    # Summed-area table with a zero row/column in front, sums are exact integers.
+    # Image could have channels as the last axis, then every channel is summed separately.
+    integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1, *image.shape[2:]), dtype=np.int64)
+    np.cumsum(np.cumsum(image, axis=0, dtype=np.int64), axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def get_integral_sums(integral, rows_start, rows_end, cols_start, cols_end):
+    def corners(rows, cols):
+        # Integral may be stored as unsigned, differences are taken in int64
+        return integral[np.ix_(rows, cols)].astype(np.int64)
+    return (corners(rows_end, cols_end) - corners(rows_start, cols_end)
+            - corners(rows_end, cols_start) + corners(rows_start, cols_start))
+
+
+def get_cell_means(image, num_cols, integral=None):
+    if integral is None:
+        integral = get_integral_image(image)
+    return get_cell_means_from_integral(integral, num_cols)
+
+
+def get_cell_means_from_integral(integral, num_cols):
+    height, width, cell_width, cell_height, num_rows = get_sizes(integral[1:, 1:], num_cols)
+    rows_start, rows_end = get_cell_bounds(height, cell_height, num_rows)
+    cols_start, cols_end = get_cell_bounds(width, cell_width, num_cols)
+    sums = get_integral_sums(integral, rows_start, rows_end, cols_start, cols_end)
+    counts = np.outer(rows_end - rows_start, cols_end - cols_start)
+    return sums / counts.reshape(counts.shape + (1,) * (sums.ndim - 2))
+
+
+def cells_to_ascii(cell_means, char_list) -> str:
+    num_chars = len(char_list)
+    num_rows, num_cols = cell_means.shape
+    # Last lookup table entry is the line break, so every row is closed in the same pass
+    lookup_table = np.array(list(char_list) + ['\n'], dtype='<U1')
+    indexes = np.full((num_rows, num_cols + 1), num_chars, dtype=np.int64)
+    indexes[:, :-1] = np.minimum((cell_means * num_chars / 255).astype(np.int64), num_chars - 1)
+    return lookup_table[indexes].tobytes().decode('utf-32-le')
+
+
 def image_to_ascii(path, num_cols=100, mode='complex', brightness=None, contrast=None) -> (str, int):
-    if mode == "simple":
-        CHAR_LIST = '@%#*+=-:. '
-    elif mode == "bars":
-        CHAR_LIST = '█▓▒░'
-    else:
-        CHAR_LIST = "$@B%8&WM#*zcvunxrjft/\|()1{}[]?-_+~<>i!lI;;::,,,\"\"\"^^^`````'''''.......     "
-    num_chars = len(CHAR_LIST)
     image = Image.open(path)
-    if contrast is not None:
-        image = ImageEnhance.Contrast(image).enhance(contrast)
-    if brightness is not None:
-        image = ImageEnhance.Brightness(image).enhance(brightness)
-    image = np.array(image)
+    image = enhance_pixels(np.array(image), brightness=brightness, contrast=contrast)
     image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width, cell_width, cell_height, num_rows = get_sizes(image, num_cols)
-    output_str = ''
-    for i in range(num_rows):
-        for j in range(num_cols):
-            output_str += CHAR_LIST[min(int(np.mean(image[int(i * cell_height):min(int((i + 1) * cell_height), height),
-                                                    int(j * cell_width):min(int((j + 1) * cell_width),
-                                                                            width)]) * num_chars / 255), num_chars - 1)]
-        output_str += '\n'
-    return output_str
+    return cells_to_ascii(get_cell_means(image, num_cols), get_char_list(mode))
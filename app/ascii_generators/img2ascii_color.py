@@ -0,0 +1,111 @@
+import html
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from . import img2ascii_2
+from .enhance import enhance_pixels
+
+OUTPUT_HTML = 'html'
+OUTPUT_ANSI = 'ansi'
+OUTPUTS = (OUTPUT_HTML, OUTPUT_ANSI)
+COLOR_LEVELS = 4  # Levels per channel, 64 colours in total
+ANSI_RESET = '\x1b[0m'
+
+
+def get_planes(pixels, brightness=None, contrast=None, mean=None):
+    """
+    Stack luminance of img2ascii_2 and RGB channels into one (height, width, 4) array,
+    so cell means of all of them are calculated in a single pass.
+    Brightness and contrast are applied to RGB channels, then luminance is calculated from them, as img2ascii_2 does.
+    :param mean: Mean of enhance.get_contrast_mean(), if it's already known.
+    """
+    pixels = enhance_pixels(pixels[:, :, :3], brightness=brightness, contrast=contrast, mean=mean)
+    gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+    return np.dstack((gray, pixels))
+
+
+def enhance_planes(planes, brightness=None, contrast=None, mean=None):
+    """
+    Planes of get_planes() with brightness and contrast applied, made from not enhanced ones.
+    """
+    if brightness is None and contrast is None:
+        return planes
+    return get_planes(planes[:, :, 1:], brightness=brightness, contrast=contrast, mean=mean)
+
+
+def quantize(color_means, levels=COLOR_LEVELS):
+    """
+    Quantize mean colours of cells to small palette.
+    :return: Array of channel levels with the same shape, values from 0 to levels - 1.
+    """
+    return np.minimum((color_means * levels / 256).astype(np.int64), levels - 1)
+
+
+def get_color_codes(quantized, chars, levels=COLOR_LEVELS):
+    """
+    Single palette code per cell. Spaces have no visible colour, they take colour of previous cell,
+    so runs are not broken by them.
+    """
+    codes = (quantized[:, :, 0] * levels + quantized[:, :, 1]) * levels + quantized[:, :, 2]
+    num_rows, num_cols = codes.shape
+    sources = np.where(chars == ' ', 0, np.arange(num_cols))
+    np.maximum.accumulate(sources, axis=1, out=sources)
+    return codes[np.arange(num_rows)[:, None], sources]
+
+
+def _get_runs(row_codes):
+    # Start indexes of runs of equal codes in a row
+    return np.flatnonzero(np.concatenate(([True], row_codes[1:] != row_codes[:-1])))
+
+
+def _split_code(code, levels):
+    return code // (levels * levels), code // levels % levels, code % levels
+
+
+def _html_color(code, levels):
+    channels = _split_code(code, levels)
+    if 15 % (levels - 1) == 0:  # Short "#rgb" form
+        return '#' + ''.join(f'{level * 15 // (levels - 1):x}' for level in channels)
+    return '#' + ''.join(f'{round(level * 255 / (levels - 1)):02x}' for level in channels)
+
+
+def _ansi_color(code, levels):
+    # Nearest colour of xterm's 6x6x6 cube
+    red, green, blue = (round(level * 5 / (levels - 1)) for level in _split_code(code, levels))
+    return f'\x1b[38;5;{16 + 36 * red + 6 * green + blue}m'
+
+
+def cells_to_color_ascii(cell_means, char_list, output=OUTPUT_HTML, levels=COLOR_LEVELS) -> str:
+    """
+    Coloured art. Characters are the same as img2ascii_2 art for the same cells,
+    every run of cells with the same colour shares one HTML span or ANSI escape sequence.
+    :param cell_means: Array of (num_rows, num_cols, 4) with luminance and RGB means.
+    :param output: "html" or "ansi".
+    """
+    num_chars = len(char_list)
+    chars = np.array(list(char_list), dtype='<U1')[
+        np.minimum((cell_means[:, :, 0] * num_chars / 255).astype(np.int64), num_chars - 1)
+    ]
+    codes = get_color_codes(quantize(cell_means[:, :, 1:], levels), chars, levels)
+    lines = []
+    for row_chars, row_codes in zip(chars, codes):
+        text = ''.join(row_chars)
+        starts = _get_runs(row_codes)
+        ends = [*starts[1:], len(text)]
+        if output == OUTPUT_ANSI:
+            line = ''.join(f'{_ansi_color(row_codes[start], levels)}{text[start:end]}'
+                           for start, end in zip(starts, ends))
+            lines.append(line + ANSI_RESET)
+        else:
+            lines.append(''.join(f'<span style=color:{_html_color(row_codes[start], levels)}>'
+                                 f'{html.escape(text[start:end])}</span>'
+                                 for start, end in zip(starts, ends)))
+    return '\n'.join(lines) + '\n'
+
+
+def image_to_ascii(path, num_cols=100, mode='complex', output=OUTPUT_HTML, brightness=None, contrast=None) -> str:
+    image = Image.open(path).convert('RGB')
+    planes = get_planes(np.array(image), brightness=brightness, contrast=contrast)
+    return cells_to_color_ascii(img2ascii_2.get_cell_means(planes, num_cols), img2ascii_2.get_char_list(mode), output)
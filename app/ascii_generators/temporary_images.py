@@ -0,0 +1,275 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from app import storage
+from .image_pipeline import RAW_SUFFIX, SIDECAR_SUFFIX, TEMPORARY_FILE_PREFIX, remove_sidecars
+
+CONTENT_NAME_LENGTH = 32
+CONTENT_NAME_RE = re.compile(rf'^[0-9a-f]{{{CONTENT_NAME_LENGTH}}}\.[0-9a-z]+$')
+BARE_NAME_RE = re.compile(r'^[0-9A-Za-z_-]+\.[0-9A-Za-z]+\Z')  # No separators, no "..", not absolute
+JANITOR_REPORT_CACHE_KEY = 'temporary_images_janitor_report'
+JANITOR_LOCK_CACHE_KEY = 'temporary_images_janitor_lock'
+
+
+def get_content_name(image, file_extension: str) -> str:
+    """
+    Name of normalized image, built from hash of its pixels, so identical uploads share one file,
+    one sidecar and one set of cache entries.
+    :return: File name with extension.
+    """
+    content_hash = hashlib.sha256(f'{image.mode} {image.width}x{image.height} '.encode())
+    content_hash.update(image.tobytes())
+    return f'{content_hash.hexdigest()[:CONTENT_NAME_LENGTH]}{file_extension.lower()}'
+
+
+def is_content_name(file_name: str) -> bool:
+    return bool(CONTENT_NAME_RE.match(file_name))
+
+
+def is_temporary_name(file_name: str) -> bool:
+    """
+    Name could be of temporary image: bare file name without any path, content name or random legacy one.
+    Only such names are resolved in temporary images folder, as files are written next to temporary images.
+    """
+    return bool(BARE_NAME_RE.match(file_name))
+
+
+def get_path(file_name: str) -> str:
+    """
+    Path of image in its shard of temporary images folder.
+    """
+    return storage.get_sharded_path(settings.TEMPORARY_IMAGES, file_name)
+
+
+def resolve(file_name: str):
+    """
+    Path of existing image, images saved before sharding are found right in temporary images folder.
+    :return: Path or None.
+    """
+    return storage.resolve(settings.TEMPORARY_IMAGES, file_name)
+
+
+def save(image, file_name: str, **params) -> bool:
+    """
+    Save normalized image under its content name, if it's not saved already.
+    Image is written to hidden temporary file first and then exclusively linked to its name,
+    so concurrent identical uploads never see partial file and never overwrite each other.
+    :return: True if image was saved, False if the same image already exists.
+    """
+    path = get_path(file_name)
+    directory, unused_name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(path):
+        os.utime(path)
+        return False
+    temporary_path = os.path.join(directory, f'{TEMPORARY_FILE_PREFIX}{os.getpid()}_{threading.get_ident()}_{file_name}')
+    try:
+        image.save(temporary_path, **params)
+    except FileNotFoundError:  # Empty shard was pruned by janitor in the meantime
+        os.makedirs(directory, exist_ok=True)
+        image.save(temporary_path, **params)
+    if not storage.link_exclusive(temporary_path, path):
+        os.utime(path)
+        return False
+    return True
+
+
+def _get_references_cache_key(file_name: str) -> str:
+    return f'temporary_image_references_{file_name}'
+
+
+def get_references(file_name: str) -> int:
+    return cache.get(_get_references_cache_key(file_name), 0)
+
+
+def add_reference(file_name: str) -> int:
+    """
+    Reference temporary image by one more upload. References are leases, they all expire
+    TEMPORARY_IMAGES_TTL after the last one was added or touched.
+    :return: Amount of references.
+    """
+    key = _get_references_cache_key(file_name)
+    try:
+        references = cache.incr(key)
+    except ValueError:  # Key is missing or expired
+        cache.add(key, 0, settings.TEMPORARY_IMAGES_TTL)
+        references = cache.incr(key)
+    cache.touch(key, settings.TEMPORARY_IMAGES_TTL)
+    return references
+
+
+def touch(file_name: str):
+    """
+    Image is still in use: extend leases of its references and update its modification time,
+    which is taken by janitor as the last access time.
+    """
+    cache.touch(_get_references_cache_key(file_name), settings.TEMPORARY_IMAGES_TTL)
+    path = resolve(file_name)
+    if path is None:
+        return
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def release_reference(file_name: str) -> int:
+    """
+    Drop one reference. Image is not removed here, even when the last one is dropped:
+    clean() removes it once it's not accessed for TEMPORARY_IMAGES_TTL, so a concurrent upload of the same
+    content or a client still showing it can keep using it.
+    :return: Remaining references.
+    """
+    key = _get_references_cache_key(file_name)
+    try:
+        references = cache.decr(key)
+    except ValueError:  # Already expired
+        return 0
+    if references <= 0:
+        cache.delete(key)
+    return max(references, 0)
+
+
+def _remove_file(path) -> (int, int):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:  # Removed by someone else in the meantime
+        return 0, 0
+    return 1, size
+
+
+def remove(file_name: str) -> (int, int):
+    """
+    Remove temporary image and all its sidecars, from its shard and from the folder itself.
+    Shard subdirectories left empty are removed too, so janitor doesn't walk them.
+    :return: Amount of removed files and their size in bytes.
+    """
+    removed, removed_bytes = 0, 0
+    for path in (get_path(file_name), os.path.join(settings.TEMPORARY_IMAGES, file_name)):
+        for count, size in (remove_sidecars(path), _remove_file(path)):
+            removed += count
+            removed_bytes += size
+    storage.prune_shard(settings.TEMPORARY_IMAGES, file_name)
+    return removed, removed_bytes
+
+
+def _get_owner(file_name: str) -> str:
+    # Image names have no dots except the extension, sidecars are "<image name>.<options>.sat.npy"
+    # and "<image name>.raw.npy"
+    return '.'.join(file_name.split('.')[:2])
+
+
+def _scan() -> (dict, list):
+    """
+    Group files of temporary images folder and its shards by image.
+    :return: Dictionary {image name: {"last_access", "bytes", "has_image"}} and list of hidden temporary files
+        as (path, modification time).
+    """
+    images = {}
+    temporary_files = []
+    for directory, unused_directories, file_names in os.walk(settings.TEMPORARY_IMAGES):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # Removed in the meantime
+                continue
+            if file_name.startswith('.'):
+                if file_name.startswith(TEMPORARY_FILE_PREFIX):
+                    temporary_files.append((path, stat.st_mtime))
+                continue
+            is_sidecar = file_name.endswith((SIDECAR_SUFFIX, RAW_SUFFIX))
+            image = images.setdefault(_get_owner(file_name) if is_sidecar else file_name,
+                                      {'last_access': 0, 'bytes': 0, 'has_image': False})
+            image['last_access'] = max(image['last_access'], stat.st_mtime)
+            image['bytes'] += stat.st_size
+            image['has_image'] = image['has_image'] or not is_sidecar
+    return images, temporary_files
+
+
+def clean(now=None, max_bytes=None) -> dict:
+    """
+    Evict temporary images together with their sidecars:
+    - not referenced anymore and not accessed for TEMPORARY_IMAGES_TTL;
+    - least recently accessed ones, while all the images are taking more than max_bytes, even if referenced
+      (client uploads image again after 410).
+    Sidecars without image and temporary files left by interrupted writes are removed too.
+    :param max_bytes: Total bytes budget, TEMPORARY_IMAGES_MAX_BYTES by default, 0 to disable.
+    :return: Report with counts of evicted images, removed files and bytes, and what is remaining.
+    """
+    now = time.time() if now is None else now
+    max_bytes = settings.TEMPORARY_IMAGES_MAX_BYTES if max_bytes is None else max_bytes
+    ttl = settings.TEMPORARY_IMAGES_TTL
+    report = {'expired': 0, 'evicted': 0, 'orphaned': 0, 'removed_files': 0, 'removed_bytes': 0}
+
+    def count(removed):
+        report['removed_files'] += removed[0]
+        report['removed_bytes'] += removed[1]
+
+    images, temporary_files = _scan()
+    for path, modified in temporary_files:
+        if now - modified >= ttl:
+            count(_remove_file(path))
+    remaining = []
+    for file_name, image in images.items():
+        if not image['has_image']:
+            report['orphaned'] += 1
+            count(remove(file_name))
+        elif now - image['last_access'] >= ttl and get_references(file_name) <= 0:
+            report['expired'] += 1
+            count(remove(file_name))
+        else:
+            remaining.append((image['last_access'], image['bytes'], file_name))
+    remaining.sort()
+    remaining_bytes = sum(size for unused_last_access, size, unused_file_name in remaining)
+    while max_bytes and remaining_bytes > max_bytes:
+        unused_last_access, size, file_name = remaining.pop(0)
+        report['evicted'] += 1
+        count(remove(file_name))
+        remaining_bytes -= size
+    report['remaining_images'] = len(remaining)
+    report['remaining_bytes'] = remaining_bytes
+    return report
+
+
+def run_janitor(now=None, max_bytes=None) -> dict:
+    """
+    Clean temporary images and keep the report for staff metrics.
+    """
+    report = clean(now=now, max_bytes=max_bytes)
+    report['time'] = time.time() if now is None else now
+    cache.set(JANITOR_REPORT_CACHE_KEY, report, None)
+    return report
+
+
+def get_janitor_report() -> dict:
+    return cache.get(JANITOR_REPORT_CACHE_KEY, {})
+
+
+def _janitor_loop(interval, stopped):
+    while not stopped.wait(interval):
+        # Only one of the processes sharing the cache is cleaning at a time
+        if cache.add(JANITOR_LOCK_CACHE_KEY, os.getpid(), interval):
+            try:
+                run_janitor()
+            except Exception:  # Janitor must keep running, files are checked again on next run
+                pass
+
+
+def start_janitor(interval) -> threading.Event:
+    """
+    Start in-process scheduler, running janitor every interval seconds in daemon thread.
+    :return: Event, janitor is stopped when it's set.
+    """
+    stopped = threading.Event()
+    thread = threading.Thread(target=_janitor_loop, args=(interval, stopped), name='temporary_images_janitor',
+                              daemon=True)
+    thread.start()
+    return stopped
@@ -0,0 +1,287 @@
+import hashlib
+import os
+import sys
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+from . import font_pack
+
+BLOCK_FONT = 'block'  # Glyphs are separated by space on their 2nd and next to last rows, spaces are skipped
+MIRROR_FONTS = ('mirror', 'mirror_flip')  # Glyphs are written from right to left
+SKIPPED_CHARS = '\t'
+SPLITTER = '\n' if sys.platform == 'win32' else '\r\n'  # Rows are joined the same way as by text2art
+
+
+def compile_font(font: str) -> dict:
+    """
+    Split every glyph of font into tuple of rows once, instead of splitting it for every character of every text.
+    Characters that text2art skips are left out, so rendering only checks if character is in glyphs.
+    :return: Dictionary with "glyphs" ({character: rows}) and font's metrics: "height", "width" (the widest row),
+        "average_width" (of glyphs), "ascii_only" (if font has glyphs only for ASCII characters),
+        "coverage" (bitmap of code points that font has glyphs for, bit N is set for chr(N)),
+        "case" (None, "lower" or "upper" - mapping applied to text), "block" and "mirror" flags.
+    """
+    from .txt2ascii_1 import FONT_MAP, UPPERCASE_FONTS  # Huge glyph dicts are imported only when compiling
+
+    letters, is_lowercase = FONT_MAP[font]
+    skipped = SKIPPED_CHARS + (' ' if font == BLOCK_FONT else '')
+    glyphs = {char: tuple(glyph.split('\n')) for char, glyph in letters.items() if glyph and char not in skipped}
+    case = None
+    if font in UPPERCASE_FONTS:
+        case = 'upper'
+    elif is_lowercase:
+        case = 'lower'
+    widths = [max(map(len, rows)) for rows in glyphs.values()]
+    return {
+        'glyphs': glyphs,
+        'height': max(map(len, glyphs.values()), default=0),
+        'width': max(widths, default=0),
+        'average_width': round(sum(widths) / len(widths), 2) if widths else 0,
+        'ascii_only': all(char.isascii() for char in glyphs),
+        'coverage': sum(1 << ord(char) for char in glyphs),
+        'case': case,
+        'block': font == BLOCK_FONT,
+        'mirror': font in MIRROR_FONTS,
+    }
+
+
+def compile_fonts() -> dict:
+    """
+    :return: Dictionary {font name: compiled font} of all the fonts of txt2ascii_1, sorted by name.
+    """
+    from .txt2ascii_1 import FONT_NAMES
+
+    return {font: compile_font(font) for font in FONT_NAMES}
+
+
+def _get_version(fonts: dict) -> str:
+    # Changes with any glyph, so cached arts of old fonts are not used
+    font_set_hash = hashlib.sha256()
+    for font_name, font in fonts.items():
+        font_set_hash.update(f'{font_name}\0{font["case"]}\0'.encode('utf-8', 'surrogatepass'))
+        for char, rows in font['glyphs'].items():
+            font_set_hash.update(f'{char}\0{"|".join(rows)}\0'.encode('utf-8', 'surrogatepass'))
+    return font_set_hash.hexdigest()[:16]
+
+
+def build_font_pack(path: str):
+    """
+    Compile all the fonts into font pack, which is used instead of txt2ascii_1 glyph dicts.
+    """
+    fonts = compile_fonts()
+    font_pack.write(path, fonts, _get_version(fonts))
+
+
+class _CompiledFonts:
+    """
+    Source of fonts if font pack is not built, all the fonts are compiled from txt2ascii_1 at once.
+    It has the same interface as FontPack.
+    """
+
+    def __init__(self):
+        self._fonts = compile_fonts()
+        self.names = list(self._fonts)
+        self.version = _get_version(self._fonts)
+        self.rendered_chars = frozenset(char for font in self._fonts.values() for char in font['glyphs'])
+        self.catalog = {font_name: {key: value for key, value in font.items() if key != 'glyphs'}
+                        for font_name, font in self._fonts.items()}
+
+    def load(self, font_name: str) -> dict:
+        return self._fonts[font_name]
+
+
+_source = None
+_source_lock = threading.Lock()
+_fonts = {}
+
+
+def get_source():
+    """
+    Font pack from FONT_PACK_PATH, opened on first use, or fonts compiled from txt2ascii_1 if there's no pack.
+    """
+    global _source
+    if _source is None:
+        with _source_lock:
+            if _source is None:
+                path = settings.FONT_PACK_PATH
+                _source = font_pack.FontPack(path) if os.path.exists(path) else _CompiledFonts()
+    return _source
+
+
+def reset():
+    """
+    Forget source and loaded fonts, they are loaded again on next use.
+    """
+    global _source
+    with _source_lock:
+        _source = None
+        _fonts.clear()
+
+
+def get_font(font_name: str) -> dict:
+    """
+    Compiled font, it's loaded from source on first use.
+    """
+    font = _fonts.get(font_name)
+    if font is None:
+        font = _fonts[font_name] = get_source().load(font_name)
+    return font
+
+
+def get_font_names() -> list:
+    return get_source().names
+
+
+def get_font_set_version() -> str:
+    return get_source().version
+
+
+def get_catalog() -> dict:
+    """
+    Metrics of all the fonts, known without loading fonts.
+    :return: Dictionary {font name: metrics}, see compile_font().
+    """
+    return get_source().catalog
+
+
+def get_max_rows(words: list, metrics: dict) -> int:
+    """
+    Upper bound of rows (parts of art split by line breaks) of words rendered with font of given metrics.
+    Every rendered word has font's height, at most. Empty words are single line break,
+    words that font covers none of characters of are skipped altogether.
+    :param words: Lines of text, with font's letter case applied.
+    """
+    line_breaks = 0
+    last = len(words) - 1
+    for index, word in enumerate(words):
+        if not word:
+            line_breaks += index != last
+        elif any(is_covered(metrics['coverage'], char) for char in word):
+            line_breaks += metrics['height'] - 1 + (index != last)
+    return line_breaks + 1
+
+
+def is_covered(coverage: int, char: str) -> bool:
+    return coverage >> ord(char) & 1 == 1
+
+
+def get_coverage(chars: Counter, coverage: int) -> float:
+    """
+    Share of characters, that font has glyphs for.
+    :param chars: Counts of visible characters of text.
+    :param coverage: Coverage bitmap of font.
+    :return: From 0 to 1, 1 if there are no characters.
+    """
+    total = sum(chars.values())
+    if not total:
+        return 1.
+    return sum(count for char, count in chars.items() if is_covered(coverage, char)) / total
+
+
+def rank_fonts(text: str, fonts: list, min_coverage=None) -> list:
+    """
+    Skip fonts that have glyphs for none of visible characters of text, their arts would be blank.
+    Fonts that cover less than min_coverage of visible characters are moved to the end.
+    :param min_coverage: TEXT_FONT_MIN_COVERAGE by default.
+    :return: Font names.
+    """
+    if min_coverage is None:
+        min_coverage = settings.TEXT_FONT_MIN_COVERAGE
+    chars = {case: Counter(char for char in case_text if not char.isspace())
+             for case, case_text in (('upper', text.upper()), ('lower', text.lower()), (None, text))}
+    catalog = get_catalog()
+    ranked, ranked_last = [], []
+    for font_name in fonts:
+        metrics = catalog[font_name]
+        coverage = get_coverage(chars[metrics['case']], metrics['coverage'])
+        if coverage >= min_coverage:
+            ranked.append(font_name)
+        elif coverage > 0:
+            ranked_last.append(font_name)
+    return ranked + ranked_last
+
+
+def select_fonts(text: str, min_rows: int) -> list:
+    """
+    Choose fonts, which arts of text could have at least min_rows rows, using only fonts' metrics.
+    :return: Font names.
+    """
+    words = {case: _get_words(text, case) for case in (None, 'lower', 'upper')}
+    catalog = get_catalog()
+    return [font_name for font_name in get_font_names()
+            if get_max_rows(words[catalog[font_name]['case']], catalog[font_name]) >= min_rows]
+
+
+def _is_ignored(char: str) -> bool:
+    # Character that no font renders, whatever letter case is applied to it
+    return char != '\n' and char not in get_source().rendered_chars and char.lower() == char == char.upper()
+
+
+def normalize(text: str) -> str:
+    """
+    Remove characters that no font renders, so texts that differ only by them share arts.
+    Words made only of such characters are kept as single tab, as they still end without line break.
+    :return: Text, rendered by text2arts() exactly like the original one.
+    """
+    words = []
+    for word in text.split('\n'):
+        normalized_word = ''.join([char for char in word if not _is_ignored(char)])
+        words.append(normalized_word if normalized_word or not word else '\t')
+    return '\n'.join(words)
+
+
+def _word_to_art(word: str, font: dict, next_word: bool) -> str:
+    if not word and next_word:
+        return SPLITTER
+    glyphs = font['glyphs']
+    word_glyphs = [glyphs[char] for char in word if char in glyphs]
+    if not word_glyphs:
+        return ''
+    if font['mirror']:
+        word_glyphs.reverse()
+    height = len(word_glyphs[0])  # Rows are counted by the first glyph, as text2art does
+    rows = []
+    for i in range(height):
+        separator = ' ' if font['block'] and (i == 1 or i == height - 2) else ''
+        rows.append(separator.join([glyph[i] for glyph in word_glyphs]))
+    result = SPLITTER.join(rows)
+    if next_word and result[-1] != '\n':
+        result += SPLITTER
+    return result
+
+
+def _get_words(text: str, case) -> list:
+    if case == 'upper':
+        text = text.upper()
+    elif case == 'lower':
+        text = text.lower()
+    return text.split('\n')
+
+
+def text2art(text: str, font: str) -> str:
+    """
+    Same art as txt2ascii_1.text2art() with default chr_ignore and no decoration, for exact font name.
+    """
+    return text2arts(text, (font,))[0][1]
+
+
+def text2arts(text: str, fonts=None) -> list:
+    """
+    Render text with every font in a single pass. Text is split into words once per letter case,
+    every art is built with joins of precompiled glyph rows.
+    :param fonts: Font names, all the fonts by default.
+    :return: List of [font, art].
+    """
+    if fonts is None:
+        fonts = get_font_names()
+    words = {case: _get_words(text, case) for case in (None, 'lower', 'upper')}
+    results = []
+    for font_name in fonts:
+        font = get_font(font_name)
+        font_words = words[font['case']]
+        last = len(font_words) - 1
+        art = ''.join([_word_to_art(word, font, index != last) for index, word in enumerate(font_words)])
+        results.append([font_name, art])
+    return results
@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+from django.conf import settings
+
+BACKEND_THREAD = 'thread'
+BACKEND_PROCESS = 'process'
+
+# Picklable description of numpy array placed in shared memory
+SharedArray = namedtuple('SharedArray', ('name', 'shape', 'dtype'))
+
+
+def call_with_arrays(fn, *args):
+    """
+    Executed in worker process: attach every SharedArray argument as numpy array, call fn, detach.
+    """
+    memories = []
+    try:
+        args = [_attach_array(arg, memories) if isinstance(arg, SharedArray) else arg for arg in args]
+        return fn(*args)
+    finally:
+        del args  # Views must be released before shared memory can be closed
+        for memory in memories:
+            memory.close()
+
+
+def _attach_array(shared_array, memories):
+    memory = shared_memory.SharedMemory(name=shared_array.name)
+    memories.append(memory)
+    return np.ndarray(shared_array.shape, dtype=shared_array.dtype, buffer=memory.buf)
+
+
+class GeneratorPool:
+    """
+    Persistent, bounded pool that is running generators in threads or in processes.
+    In process mode, arrays reach the workers through shared memory instead of being pickled.
+    Process pool is broken for good once any of its workers dies, get_pool() replaces such pool.
+    """
+
+    def __init__(self, backend=BACKEND_THREAD, max_workers=2, max_queue=16, start_method=None):
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.broken = False
+        if backend == BACKEND_PROCESS:
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=_get_context(start_method))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ascii_generator')
+        # Submitting blocks when all workers are busy and queue is full
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._submitted = 0
+        self._completed = 0
+
+    def submit(self, fn, *args):
+        """
+        Submit fn to the pool, SharedArray arguments are attached in worker process.
+        :return: Future.
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+            self._submitted += 1
+        try:
+            if self.backend == BACKEND_PROCESS:
+                future = self._executor.submit(call_with_arrays, fn, *args)
+            else:
+                future = self._executor.submit(fn, *args)
+        except BaseException as error:
+            self.broken = self.broken or isinstance(error, BrokenProcessPool)
+            self._task_done(None)
+            raise
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        if future is not None and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self.broken = True
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+
+    @contextmanager
+    def share(self, *arrays):
+        """
+        Prepare numpy arrays to be passed to submit().
+        In process mode, they are copied into shared memory and freed on exit, otherwise passed as is.
+        """
+        if self.backend != BACKEND_PROCESS:
+            yield arrays
+            return
+        memories = []
+        try:
+            shared_arrays = []
+            for array in arrays:
+                memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                memories.append(memory)
+                np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+                shared_arrays.append(SharedArray(memory.name, array.shape, array.dtype.str))
+            yield shared_arrays
+        finally:
+            for memory in memories:
+                memory.close()
+                memory.unlink()
+
+    def metrics(self) -> dict:
+        """
+        Current load of the pool, used to size it per node.
+        """
+        with self._lock:
+            in_flight = self._in_flight
+            submitted = self._submitted
+            completed = self._completed
+        return {
+            'backend': self.backend,
+            'workers': self.max_workers,
+            'workers_busy': min(in_flight, self.max_workers),
+            'queue_depth': max(in_flight - self.max_workers, 0),
+            'queue_size': self.max_queue,
+            'submitted': submitted,
+            'completed': completed,
+        }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def _get_context(start_method=None):
+    start_method = start_method or settings.ASCII_GENERATOR_START_METHOD
+    if start_method not in multiprocessing.get_all_start_methods():  # No forkserver on Windows
+        start_method = 'spawn'
+    return multiprocessing.get_context(start_method)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> GeneratorPool:
+    """
+    Get pool of this process, it's created on first use from settings, and again if its worker died.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Pool of parent process can't be used after fork
+        if _pool is None or _pool_pid != os.getpid() or _pool.broken:
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.shutdown(wait=False)
+            _pool = GeneratorPool(
+                backend=settings.ASCII_GENERATOR_BACKEND,
+                max_workers=settings.ASCII_GENERATOR_WORKERS,
+                max_queue=settings.ASCII_GENERATOR_QUEUE_SIZE,
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def get_metrics() -> dict:
+    """
+    Metrics of this process' pool, empty if pool is not created yet.
+    """
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    return _pool.metrics()
@@ -0,0 +1,230 @@
+import pickle
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+COMPRESS_LEVEL = 6
+CHUNKED = 'chunked'
+COMPRESSED = 'compressed'
+
+_lock = threading.Lock()
+_metrics = {
+    'sets': 0,
+    'set_failures': 0,
+    'chunked_sets': 0,
+    'hits': 0,
+    'misses': 0,
+    'bytes_raw': 0,
+    'bytes_stored': 0,
+    'coalesced': 0,
+    'local_hits': 0,
+}
+
+
+def _count(**counters):
+    with _lock:
+        for name, value in counters.items():
+            _metrics[name] += value
+
+
+def _get_chunk_key(key: str, version: str, index: int) -> str:
+    return f'{key}_chunk_{version}_{index}'
+
+
+def set_large(key: str, value, timeout=None) -> bool:
+    """
+    Pickle and compress value, then store it in the cache. Values that don't fit into single cache item
+    (memcached's limit is 1 MB) are split into chunks, which are stored before the head item pointing to them.
+    :return: False if the cache refused to store anything.
+    """
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    raw_size = len(data)
+    data = zlib.compress(data, COMPRESS_LEVEL)
+    chunk_size = settings.CACHE_CHUNK_SIZE
+    if len(data) <= chunk_size:
+        items = {key: (COMPRESSED, data)}
+    else:
+        # Every write has its own chunk keys, so readers never mix chunks of different values
+        version = uuid.uuid4().hex[:8]
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        items = {_get_chunk_key(key, version, i): chunk for i, chunk in enumerate(chunks)}
+        failed_keys = cache.set_many(items, timeout)
+        if failed_keys:
+            _count(sets=1, set_failures=1)
+            return False
+        items = {key: (CHUNKED, version, len(chunks))}
+    failed_keys = cache.set_many(items, timeout)
+    _count(
+        sets=1,
+        set_failures=int(bool(failed_keys)),
+        chunked_sets=int(items[key][0] == CHUNKED),
+        bytes_raw=raw_size,
+        bytes_stored=len(data),
+    )
+    return not failed_keys
+
+
+def _get(key: str):
+    head = cache.get(key)
+    # Values cached before set_large() was used for the key are plain objects, they are treated as missing
+    if not isinstance(head, tuple) or not head:
+        return None
+    if head[0] == CHUNKED and len(head) == 3:
+        unused_kind, version, num_chunks = head
+        chunk_keys = [_get_chunk_key(key, version, i) for i in range(num_chunks)]
+        chunks = cache.get_many(chunk_keys)
+        if len(chunks) != num_chunks:  # Some chunk was evicted
+            return None
+        data = b''.join(chunks[chunk_key] for chunk_key in chunk_keys)
+    elif head[0] == COMPRESSED and len(head) == 2:
+        data = head[1]
+    else:
+        return None
+    return pickle.loads(zlib.decompress(data))
+
+
+def get_large(key: str, default=None):
+    """
+    Get value stored by set_large(), all its chunks are fetched with one request.
+    :return: Value, or default if value or any of its chunks is missing.
+    """
+    value = _get(key)
+    if value is None:
+        _count(misses=1)
+        return default
+    _count(hits=1)
+    return value
+
+
+class LocalCache:
+    """
+    In-process least recently used tier in front of the shared cache, for values that are requested often
+    and are costly to unpickle. Values are shared between requests, so they must not be changed.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_or_set_single_flight(key: str, compute, timeout=None, local_cache=None):
+    """
+    Get value from the cache, or compute and store it, making sure that identical concurrent calls
+    compute it only once. Threads of one process wait for the leader's result directly,
+    other processes wait for it to appear in the cache while the leader is holding short cache lock.
+    If the leader fails or is too slow, waiters compute value by themselves.
+    :param compute: Function without arguments, its result must not be None.
+    :param local_cache: LocalCache, checked before the shared cache and filled with the value.
+    :return: Value.
+    """
+    if local_cache is None:
+        return _get_or_set_single_flight(key, compute, timeout)
+    value = local_cache.get(key)
+    if value is not None:
+        _count(local_hits=1)
+        return value
+    value = _get_or_set_single_flight(key, compute, timeout)
+    local_cache.set(key, value)
+    return value
+
+
+def _get_or_set_single_flight(key: str, compute, timeout=None):
+    value = get_large(key)
+    if value is not None:
+        return value
+    with _flights_lock:
+        flight = _flights.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _flights[key] = _Flight()
+    if not is_leader:
+        if flight.done.wait(settings.SINGLE_FLIGHT_WAIT) and not flight.failed:
+            _count(coalesced=1)
+            return flight.value
+        return compute()
+    try:
+        flight.value = _compute_locked(key, compute, timeout)
+    except BaseException:
+        flight.failed = True
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.value
+
+
+def _compute_locked(key: str, compute, timeout=None):
+    lock_key = f'{key}_lock'
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, settings.SINGLE_FLIGHT_LOCK_TIMEOUT):
+        try:
+            value = _get(key)  # Could be stored by another process right before the lock was taken
+            if value is None:
+                value = compute()
+                set_large(key, value, timeout)
+            return value
+        finally:
+            # Lock expires if compute is too slow and someone else could hold it already, only own lock is released
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        value = _get(key)
+        if value is not None:
+            _count(coalesced=1)
+            return value
+        if cache.get(lock_key) is None:  # Leader failed, or its value could not be stored
+            break
+    value = compute()
+    set_large(key, value, timeout)
+    return value
+
+
+def get_metrics() -> dict:
+    """
+    Counters of this process, set_failures are values that the cache refused to store.
+    """
+    with _lock:
+        return dict(_metrics)
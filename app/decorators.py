@@ -1,4 +1,9 @@
+import threading
+
 from django.shortcuts import redirect
+from django.http import JsonResponse
+from django.conf import settings
+from django.core.cache import cache
 
 
 def redirect_if_not_ajax(url: str):
@@ -9,3 +14,115 @@ def redirect_if_not_ajax(url: str):
             return func(request, *args, **kwargs)
         return wrapper
     return decorator
+
+
+class ConcurrencyLimiter:
+    """
+    Limits amount of requests in work, per process and for all the processes sharing the cache.
+    Global counter lives in the cache with timeout, so counts of killed processes are expiring by themselves.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+
+    def _cache_key(self, counter: str) -> str:
+        return f'concurrency_limiter_{self.name}_{counter}'
+
+    def _cache_incr(self, counter: str, delta=1, timeout=None) -> int:
+        key = self._cache_key(counter)
+        try:
+            return cache.incr(key, delta)
+        except ValueError:  # Key is missing or expired
+            cache.add(key, 0, timeout)
+            return cache.incr(key, delta)
+
+    def acquire(self) -> bool:
+        """
+        Take a slot for request.
+        :return: False if limit is reached and request should be rejected.
+        """
+        with self._lock:
+            admitted = self._in_flight < settings.GENERATORS_PROCESS_LIMIT
+            if admitted:
+                self._in_flight += 1
+            else:
+                self._rejected += 1
+        if admitted and settings.GENERATORS_GLOBAL_LIMIT:
+            timeout = settings.GENERATORS_GLOBAL_COUNTER_TIMEOUT
+            if self._cache_incr('in_flight', timeout=timeout) > settings.GENERATORS_GLOBAL_LIMIT:
+                self._cache_incr('in_flight', -1, timeout=timeout)
+                with self._lock:
+                    self._in_flight -= 1
+                    self._rejected += 1
+                admitted = False
+        if not admitted:
+            self._cache_incr('rejected')
+        return admitted
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        if settings.GENERATORS_GLOBAL_LIMIT:
+            timeout = settings.GENERATORS_GLOBAL_COUNTER_TIMEOUT
+            if self._cache_incr('in_flight', -1, timeout=timeout) < 0:  # Counter expired while request was in work
+                cache.set(self._cache_key('in_flight'), 0, timeout)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            in_flight = self._in_flight
+            rejected = self._rejected
+        return {
+            'in_flight': in_flight,
+            'rejected': rejected,
+            'in_flight_global': max(cache.get(self._cache_key('in_flight'), 0), 0),
+            'rejected_global': cache.get(self._cache_key('rejected'), 0),
+        }
+
+
+generators_limiter = ConcurrencyLimiter('generators')
+
+
+class _ReleaseOnClose:
+    """
+    Streaming content that releases limiter's slot when response is closed, even if it was never iterated.
+    """
+
+    def __init__(self, content, limiter: ConcurrencyLimiter):
+        self.content = content
+        self.limiter = limiter
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+def limit_concurrency(limiter: ConcurrencyLimiter):
+    """
+    Reject request with 503 and Retry-After, if limiter has no free slot.
+    """
+    def decorator(func):
+        def wrapper(request, *args, **kwargs):
+            if not limiter.acquire():
+                response = JsonResponse({'error': 'Server is busy, please try again later.'}, status=503)
+                response['Retry-After'] = str(settings.GENERATORS_RETRY_AFTER)
+                return response
+            try:
+                response = func(request, *args, **kwargs)
+            except BaseException:
+                limiter.release()
+                raise
+            if response.streaming:  # Content is generated after view returns, slot is kept until it's closed
+                response.streaming_content = _ReleaseOnClose(response.streaming_content, limiter)
+            else:
+                limiter.release()
+            return response
+        return wrapper
+    return decorator
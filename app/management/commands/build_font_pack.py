@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.ascii_generators import txt2ascii_2
+
+
+class Command(BaseCommand):
+    help = 'Compile fonts of text to ascii generator into font pack, that is memory-mapped by every process.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None, help='Path of font pack, FONT_PACK_PATH by default.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.FONT_PACK_PATH
+        txt2ascii_2.build_font_pack(path)
+        self.stdout.write(f'Font pack is saved to {path}.')
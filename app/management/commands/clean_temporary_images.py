@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app.ascii_generators import temporary_images
+
+
+class Command(BaseCommand):
+    help = 'Evict expired and least recently used temporary images with all the data derived from them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, default=None,
+                            help='Total bytes budget of temporary images, TEMPORARY_IMAGES_MAX_BYTES by default.')
+
+    def handle(self, *args, **options):
+        report = temporary_images.run_janitor(max_bytes=options['max_bytes'])
+        self.stdout.write(
+            f"Expired images: {report['expired']}, evicted images: {report['evicted']}, "
+            f"orphaned sidecars of: {report['orphaned']}.\n"
+            f"Removed files: {report['removed_files']}, removed bytes: {report['removed_bytes']}.\n"
+            f"Remaining images: {report['remaining_images']}, remaining bytes: {report['remaining_bytes']}."
+        )
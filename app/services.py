@@ -1,22 +1,22 @@
 import os
-import random
-import string
 import json
 
 from django.shortcuts import reverse
 from django.http import JsonResponse
 from django.conf import settings
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.utils.translation import gettext_lazy as _
 from django.http import Http404
-from django.core.cache import cache
+from PIL import Image
 
+from app import caching, storage
 from app.forms import FeedbackForm, ReportForm
 from app.models import (
     GeneratedASCII, Report, ImageToASCIIType,
     ImageToASCIIOptions, TextToASCIIType
 )
-from app.ascii_generators import ascii_generators
+from app.ascii_generators import ascii_generators, image_pipeline, temporary_images
 
 
 class FeedbackService:
@@ -68,26 +68,11 @@ class ReportService:
 
 
 class GeneratedASCIIService:
-    @staticmethod
-    def _generate_unique_image_path(file_extension, r=0, r_max=10):
-        """
-        Recursive function that generates random, but unique file name and path.
-        :return: Full path to file, name with extension. Return 2 nones if too many recursions.
-        """
-        name = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-        full_name = f'{name}{file_extension}'
-        full_path = os.path.join(settings.MEDIA_ROOT, 'input_images/', full_name)
-        if os.path.exists(full_path):
-            if r >= r_max:
-                return None, None
-            full_path, full_name = GeneratedASCIIService._generate_unique_image_path(file_extension, r=r + 1)
-        return full_path, full_name
-
     @staticmethod
     def get_active_object_or_404(ascii_url_code: str) -> GeneratedASCII:
         # find it in cache, if not found - set it
         key = f'GeneratedASCIIService_get_object_or_404_{ascii_url_code}'
-        generated_ascii = cache.get(key)
+        generated_ascii = caching.get_large(key)
         if not generated_ascii:
             try:
                 generated_ascii = GeneratedASCII.objects.select_related(
@@ -97,7 +82,7 @@ class GeneratedASCIIService:
                 ).get(url_code=ascii_url_code)
             except GeneratedASCII.DoesNotExist:
                 raise Http404
-            cache.set(key, generated_ascii, settings.CACHE_TIMEOUT_LONG)
+            caching.set_large(key, generated_ascii, settings.CACHE_TIMEOUT_LONG)
         # we don't want to return hidden object
         if generated_ascii.is_hidden:
             raise Http404
@@ -111,6 +96,22 @@ class GeneratedASCIIService:
         """
         return hasattr(ascii_obj, 'text_to_ascii_type')
 
+    @staticmethod
+    def _get_shared_image_file(path: str, file) -> File:
+        """
+        Temporary image is a quickly encoded lossy preview, so shared image is encoded again from its raw planes
+        with high quality. Lossless images and images without raw planes are copied as is.
+        :param path: Path of temporary image.
+        :param file: Opened temporary image.
+        """
+        image = Image.open(file)
+        file.seek(0)
+        raw_path = image_pipeline.get_raw_path(path)
+        # Raw planes have no alpha channel
+        if image.format not in image_pipeline.LOSSY_FORMATS or image.mode != 'RGB' or not os.path.exists(raw_path):
+            return File(file)
+        return ContentFile(image_pipeline.encode_raw(raw_path, image.format, **ascii_generators.SHARE_SAVE_PARAMS))
+
     @staticmethod
     def create(request) -> JsonResponse:
         """
@@ -123,7 +124,7 @@ class GeneratedASCIIService:
         if request.POST.get('file_name', False):
             # Generate ImageToASCII results from request
             img2ascii_mode = True
-            result = ascii_generators.image_to_ascii_generator(request)
+            result = ascii_generators.image_to_ascii_generator(request, single=True)
         else:
             # Generate TextToASCII results from request
             img2ascii_mode = False
@@ -150,12 +151,14 @@ class GeneratedASCIIService:
             image_to_ascii_type_obj = ImageToASCIIType(
                 generated_ascii=ascii_obj,
             )
-            with open(os.path.join(settings.TEMPORARY_IMAGES, result['file_name']), 'rb') as file:
+            path = temporary_images.resolve(result['file_name'])
+            with open(path, 'rb') as file:
                 _unused_fn, file_extension = os.path.splitext(file.name)
-                _unused_path, file_name = GeneratedASCIIService._generate_unique_image_path(file_extension)
+                # Storage creates file exclusively and picks another name if it's taken
+                file_name = storage.get_sharded_name(storage.generate_random_name(file_extension))
                 image_to_ascii_type_obj.input_image.save(
                     file_name,
-                    File(file),
+                    GeneratedASCIIService._get_shared_image_file(path, file),
                 )
                 image_to_ascii_type_obj.save()
 
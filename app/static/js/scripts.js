@@ -242,8 +242,12 @@ $(document).ready(function () {
         const fileUploadModal = $('section.index .file-upload__modal');
         const asciiImageOutput = $('section.index .ascii-image-output');
         const csrf_token = fileDropZone.find('input[name="csrfmiddlewaretoken"]').val();
+        const previous_file_name = $('section.index .ascii-image-output .image img').data('file_name');
         let data = new FormData();
         data.append('img', file);
+        if (previous_file_name) {  // server can drop image that is not displayed anymore
+            data.append('previous_file_name', previous_file_name);
+        }
 
         if (!(hidden)) {
             const placement = fileDropZone.offset().top - 25;
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import random
+import string
+
+SHARD_LEVELS = 2  # Subdirectories of 256 entries each
+SHARD_WIDTH = 2
+
+
+def get_shard(file_name: str) -> str:
+    """
+    Hashed subdirectory of file, so files are spread evenly whatever their names are.
+    :return: Relative path like "3f/a0".
+    """
+    name_hash = hashlib.sha1(file_name.encode()).hexdigest()
+    return '/'.join(name_hash[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS))
+
+
+def get_sharded_name(file_name: str) -> str:
+    return f'{get_shard(file_name)}/{file_name}'
+
+
+def get_sharded_path(directory: str, file_name: str) -> str:
+    return os.path.join(directory, get_shard(file_name), file_name)
+
+
+def prune_shard(directory: str, file_name: str):
+    """
+    Remove shard subdirectories of file that are left empty, the deepest first.
+    """
+    shard = get_shard(file_name).split('/')
+    for level in range(len(shard), 0, -1):
+        try:
+            os.rmdir(os.path.join(directory, *shard[:level]))
+        except FileNotFoundError:  # Removed by someone else in the meantime
+            continue
+        except OSError:  # Not empty, so neither are its parents
+            return
+
+
+def resolve(directory: str, file_name: str):
+    """
+    Find file by its name, in its shard or, for files saved before sharding, right in the directory.
+    :return: Full path or None if file doesn't exist.
+    """
+    for path in (get_sharded_path(directory, file_name), os.path.join(directory, file_name)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def generate_random_name(file_extension: str, length=20) -> str:
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length)) + file_extension
+
+
+def link_exclusive(source_path: str, path: str) -> bool:
+    """
+    Atomically publish fully written source file under path, only if path doesn't exist yet.
+    Source file is removed in any case.
+    :return: False if path already existed.
+    """
+    try:
+        os.link(source_path, path)  # Fails if path exists, there's no window between check and write
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(source_path)
+    return True
@@ -1,20 +1,68 @@
+import html
+import io
 import json
 import random
+import shutil
+import signal
+import tempfile
+import re
 import string
 import os
+import threading
+import time
 
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
 from unittest import mock
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.conf import settings
 from django.core.files import File
+from django.core.cache import cache
+from django.core.management import call_command
 
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFile, ImageSequence
+
+from app.ascii_generators import (
+    animation, ascii_generators, enhance, font_pack, image_probe, img2ascii_1, img2ascii_2, img2ascii_color,
+    image_pipeline, temporary_images, txt2ascii_1, txt2ascii_2, workers
+)
+from app import caching, storage
+from app.decorators import ConcurrencyLimiter, generators_limiter
 from app.models import (
     GeneratedASCII, Report, ImageToASCIIType,
     ImageToASCIIOptions, TextToASCIIType, Feedback
 )
 
 
+def _remove_temporary_image(file_path):
+    """
+    Remove temporary image with all the data derived from it
+    """
+    os.remove(file_path)
+    image_pipeline.remove_sidecars(file_path)
+    storage.prune_shard(settings.TEMPORARY_IMAGES, os.path.basename(file_path))
+
+
+def _remove_shared_image(file_path):
+    """
+    Remove input image of shared art together with its shard, if it's left empty
+    """
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    storage.prune_shard(os.path.join(settings.MEDIA_ROOT, 'input_images'), os.path.basename(file_path))
+
+
+def _remove_shared_images():
+    """
+    Remove input images of all the shared arts, that tests left in database
+    """
+    for image_to_ascii_type in ImageToASCIIType.objects.all():
+        _remove_shared_image(image_to_ascii_type.input_image.path)
+
+
 class TestHandler404View(TestCase):
 
     def test_404(self):
@@ -266,14 +314,14 @@ class TestImageToAsciiGeneratorView(TestCase):
                                         format='multipart')
         json_content = json.loads(response.content, encoding='utf-8')
         file_name = json_content.get('file_name', '')
-        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
+        file_path = temporary_images.get_path(file_name)
         self.assertEqual(response.status_code, 200)
         # Check if there's 3 or more arts
         self.assertGreaterEqual(len(json_content.get('arts', [])), 3)
         # Check if image is actually saved
         self.assertTrue(os.path.exists(file_path))
         # Delete temporary image after test
-        os.remove(file_path)
+        _remove_temporary_image(file_path)
 
     def test_non_ajax(self):
         """
@@ -366,10 +414,10 @@ class TestImageToAsciiGeneratorView(TestCase):
                                         format='multipart')
         json_content = json.loads(response.content, encoding='utf-8')
         file_name = json_content.get('file_name', '')
-        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
+        file_path = temporary_images.get_path(file_name)
         self.assertEqual(response.status_code, 200)
         self.assertLess(json_content.get('num_cols', 0), 300)
-        os.remove(file_path)
+        _remove_temporary_image(file_path)
 
     def test_ajax_post_right_image_high_num_cols(self):
         """
@@ -382,10 +430,10 @@ class TestImageToAsciiGeneratorView(TestCase):
                                         format='multipart')
         json_content = json.loads(response.content, encoding='utf-8')
         file_name = json_content.get('file_name', '')
-        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
+        file_path = temporary_images.get_path(file_name)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json_content.get('num_cols', 0), 300)
-        os.remove(file_path)
+        _remove_temporary_image(file_path)
 
     def test_ajax_post_right_image_wrong_settings(self):
         """
@@ -401,12 +449,12 @@ class TestImageToAsciiGeneratorView(TestCase):
                                         format='multipart')
         json_content = json.loads(response.content, encoding='utf-8')
         file_name = json_content.get('file_name', '')
-        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
+        file_path = temporary_images.get_path(file_name)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json_content.get('num_cols', 0), 90)
         self.assertEqual(json_content.get('brightness', 0), 100)
         self.assertEqual(json_content.get('contrast', 0), 100)
-        os.remove(file_path)
+        _remove_temporary_image(file_path)
 
     def test_ajax_post_right_image_with_settings(self):
         """
@@ -422,19 +470,19 @@ class TestImageToAsciiGeneratorView(TestCase):
                                         format='multipart')
         json_content = json.loads(response.content, encoding='utf-8')
         file_name = json_content.get('file_name', '')
-        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
+        file_path = temporary_images.get_path(file_name)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json_content.get('num_cols', 0), 125)
         self.assertEqual(json_content.get('brightness', 0), 200)
         self.assertEqual(json_content.get('contrast', 0), 500)
-        os.remove(file_path)
+        _remove_temporary_image(file_path)
 
     def test_ajax_post_right_file_name(self):
         """
         Ajax POST with right file_name and settings should return new arts and settings without actual file upload
         """
         file_name = 'test_image_' + ''.join(random.choices(string.ascii_lowercase, k=10)) + '.jpg'
-        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)
+        file_path = os.path.join(settings.TEMPORARY_IMAGES, file_name)  # Saved before sharding
         with open('_images/test/test_img_good.jpg', mode='rb') as file:
             with open(file_path, 'wb') as file_new:
                 file_new.write(file.read())
@@ -452,7 +500,1132 @@ class TestImageToAsciiGeneratorView(TestCase):
         self.assertEqual(json_content.get('num_cols', 0), 125)
         self.assertEqual(json_content.get('brightness', 0), 200)
         self.assertEqual(json_content.get('contrast', 0), 500)
-        os.remove(file_path)
+        _remove_temporary_image(file_path)
+
+    def test_ajax_post_file_name_outside_temporary_images(self):
+        """
+        Ajax POST with file_name pointing outside of temporary images folder should not be treated as temporary image,
+        no files should be written next to it
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shutil.copy('_images/test/test_img_good.jpg', os.path.join(directory, 'img.jpg'))
+        for file_name in (os.path.relpath(os.path.join(directory, 'img.jpg'), settings.TEMPORARY_IMAGES),
+                          os.path.join(directory, 'img.jpg')):
+            self.client.post(reverse('image_to_ascii_generator_url'),
+                             HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                             data={'file_name': file_name, 'num_cols': 80})
+            self.assertEqual(os.listdir(directory), ['img.jpg'])
+
+    def test_ajax_post_file_name_decoded_once(self):
+        """
+        Re-generating arts of uploaded image should not decode image file, arts are made from its raw planes,
+        and should be the same as separate generators make from the uploaded file
+        """
+        with open('_images/test/test_img_good.jpg', mode='rb') as file:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'img': file},
+                                        format='multipart')
+        file_name = json.loads(response.content, encoding='utf-8').get('file_name', '')
+        file_path = temporary_images.get_path(file_name)
+        with mock.patch.object(image_pipeline.Image, 'open', wraps=Image.open) as image_open:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'file_name': file_name, 'num_cols': 80, 'brightness': 120})
+        json_content = json.loads(response.content, encoding='utf-8')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(image_open.call_count, 0)
+        source_path = '_images/test/test_img_good.jpg'  # Fits into max size, so raw planes have its exact pixels
+        self.assertEqual(json_content.get('arts'), [
+            img2ascii_2.image_to_ascii(source_path, num_cols=80, mode='simple', brightness=1.2, contrast=1.),
+            img2ascii_2.image_to_ascii(source_path, num_cols=80, mode='bars', brightness=1.2, contrast=1.),
+            img2ascii_2.image_to_ascii(source_path, num_cols=80, mode='complex', brightness=1.2, contrast=1.),
+            img2ascii_1.image_to_ascii(source_path, num_cols=80, brightness=1.2, contrast=1.),
+        ])
+        _remove_temporary_image(file_path)
+
+    def test_ajax_post_progressive(self):
+        """
+        Progressive render should stream preview of chosen method and then the full result,
+        both from raw planes, without decoding image file
+        """
+        cache.clear()
+        with open('_images/test/test_img_good.jpg', mode='rb') as file:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'img': file},
+                                        format='multipart')
+        file_name = response.json()['file_name']
+        file_path = temporary_images.get_path(file_name)
+        data = {'file_name': file_name, 'num_cols': 120, 'brightness': 80}
+        with mock.patch.object(image_pipeline.Image, 'open', wraps=Image.open) as image_open:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={**data, 'preview_method': 2})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            self.assertEqual(generators_limiter.metrics()['in_flight'], 1)  # Slot is kept while streaming
+            preview, result = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(generators_limiter.metrics()['in_flight'], 0)
+        self.assertEqual(image_open.call_count, 0)
+        self.assertEqual(preview['preview'], {
+            'method': 2,
+            'num_cols': 30,
+            'art': img2ascii_2.image_to_ascii('_images/test/test_img_good.jpg', num_cols=30, mode='complex',
+                                              brightness=0.8),
+        })
+        cache.clear()
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data=data)
+        self.assertEqual(result, response.json())
+        # Cached result is returned at once
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={**data, 'preview_method': 2})
+        self.assertEqual(response.json(), result)
+        _remove_temporary_image(file_path)
+
+    def test_ajax_post_num_cols_batch(self):
+        """
+        Batch of widths should be rendered without decoding image file and be equal to single renders
+        """
+        cache.clear()
+        with open('_images/test/test_img_good.jpg', mode='rb') as file:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'img': file},
+                                        format='multipart')
+        file_name = response.json()['file_name']
+        file_path = temporary_images.get_path(file_name)
+        with mock.patch.object(image_pipeline.Image, 'open', wraps=Image.open) as image_open:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'file_name': file_name, 'num_cols_batch': '40:80:20', 'contrast': 90})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(image_open.call_count, 0)
+        renders = response.json()['renders']
+        self.assertEqual([render['num_cols'] for render in renders], [40, 60, 80])
+        cache.clear()
+        for render in renders:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'file_name': file_name, 'num_cols': render['num_cols'], 'contrast': 90})
+            self.assertEqual(response.json(), render)
+        _remove_temporary_image(file_path)
+
+
+class TestParseNumColsBatch(TestCase):
+    def test_parse(self):
+        """
+        Batch of widths should be parsed from list or range, limited and validated like single num_cols
+        """
+        parse = ascii_generators._parse_num_cols_batch
+        self.assertEqual(parse('60,90, 120', 1000), [60, 90, 120])
+        self.assertEqual(parse('60:120:30', 1000), [60, 90, 120])
+        self.assertEqual(parse('60:120:30', 80), [60, 80])  # Small image
+        self.assertEqual(parse('0,-5,10,10', 1000), [10])
+        self.assertEqual(len(parse('1:1000:1', 1000)), ascii_generators.NUM_COLS_BATCH_MAX)
+        self.assertEqual(parse(f'{-10 ** 18}:{10 ** 18}:{10 ** 17}', 100), [100])  # Huge range is not walked
+        self.assertEqual(parse(f'{-10 ** 18 + 5}:{10 ** 18}:1', 1000)[:3], [1, 2, 3])
+        self.assertEqual(parse('-5:150:50', 120), [45, 95, 120])
+        for value in ('', 'abc', '1:2', '10:20:0', '10:5:1'):
+            self.assertEqual(parse(value, 1000), [])
+        with self.settings(DEBUG=False):
+            self.assertEqual(parse('100,1000', 1000), [100, ascii_generators.NUM_COLS_MAX])
+
+
+def _create_big_image(image_format, size=(4000, 3000)):
+    """
+    Create big gradient image in memory
+    """
+    rows, cols = np.indices((size[1], size[0]))
+    pixels = np.dstack(((rows % 256), (cols % 256), ((rows + cols) % 256))).astype(np.uint8)
+    file = io.BytesIO()
+    Image.fromarray(pixels).save(file, image_format)
+    file.seek(0)
+    file.name = f'big_image.{image_format.lower()}'
+    return file
+
+
+class TestReduce(TestCase):
+
+    @staticmethod
+    def _probe_and_reduce(file):
+        # The same way as uploaded image: size is planned from the header, then image is decoded reduced to it
+        file.size = len(file.getvalue())
+        image, plan = image_probe.probe(file, ascii_generators.IMAGE_MAX_SIZE)
+        return ascii_generators._reduce(image, plan['size'])
+
+    def test_reduced_before_resample(self):
+        """
+        Big images should be decoded (JPEG) or reduced (others) close to max size before final resample
+        """
+        for image_format in ('JPEG', 'PNG'):
+            with mock.patch.object(Image.Image, 'resize', autospec=True, side_effect=Image.Image.resize) as resize:
+                image = self._probe_and_reduce(_create_big_image(image_format))
+            self.assertEqual(image.size, (1000, 750))
+            source_image = resize.call_args[0][0]
+            self.assertLessEqual(source_image.width, 1000 * ascii_generators.IMAGE_REDUCING_GAP)
+            self.assertLessEqual(source_image.height, 750 * ascii_generators.IMAGE_REDUCING_GAP)
+
+    def test_small_image_not_changed(self):
+        """
+        Images that are fitting into max size should be returned as is
+        """
+        with open('_images/test/test_img_good_big.jpg', mode='rb') as file:
+            image = self._probe_and_reduce(io.BytesIO(file.read()))
+        self.assertEqual(image.size, (772, 780))
+
+    def test_upload_big_image(self):
+        """
+        Uploaded big image should be saved downscaled
+        """
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'img': _create_big_image('PNG', size=(1500, 3000))},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 200)
+        file_path = temporary_images.get_path(response.json()['file_name'])
+        self.assertEqual(Image.open(file_path).size, (500, 1000))
+        _remove_temporary_image(file_path)
+
+
+def _reference_img2ascii_2(path, num_cols, mode, brightness=None, contrast=None):
+    """
+    Original per-cell loop of img2ascii_2, used to check that the vectorized engine is byte-identical
+    """
+    char_list = img2ascii_2.get_char_list(mode)
+    num_chars = len(char_list)
+    image = Image.open(path)
+    if contrast is not None:
+        image = ImageEnhance.Contrast(image).enhance(contrast)
+    if brightness is not None:
+        image = ImageEnhance.Brightness(image).enhance(brightness)
+    image = cv2.cvtColor(np.array(image), cv2.COLOR_BGR2GRAY)
+    height, width, cell_width, cell_height, num_rows = img2ascii_2.get_sizes(image, num_cols)
+    output_str = ''
+    for i in range(num_rows):
+        for j in range(num_cols):
+            output_str += char_list[min(int(np.mean(image[int(i * cell_height):min(int((i + 1) * cell_height), height),
+                                                    int(j * cell_width):min(int((j + 1) * cell_width),
+                                                                            width)]) * num_chars / 255), num_chars - 1)]
+        output_str += '\n'
+    return output_str
+
+
+class TestImageProbe(TestCase):
+    limits = {
+        'default': {'max_bytes': 0, 'max_pixels': 2000 * 2000, 'max_frames': 1},
+        'PNG': {'max_pixels': 1000 * 1000},
+    }
+
+    def _upload(self, file):
+        return self.client.post(reverse('image_to_ascii_generator_url'),
+                                HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                data={'img': file},
+                                format='multipart')
+
+    def test_rejected_before_decode(self):
+        """
+        Image over the limits of its format should be rejected without decoding, and counted
+        """
+        metrics = image_probe.get_metrics()
+        with override_settings(IMAGE_PROBE_LIMITS=self.limits), \
+                mock.patch.object(ImageFile.ImageFile, 'load', autospec=True) as load:
+            response = self._upload(_create_big_image('PNG', size=(1500, 1000)))
+        load.assert_not_called()
+        self.assertEqual(response.status_code, 413)
+        new_metrics = image_probe.get_metrics()
+        self.assertEqual(new_metrics['rejected'] - metrics['rejected'], 1)
+        self.assertEqual(new_metrics['rejected_pixels'] - metrics['rejected_pixels'], 1500 * 1000)
+        self.assertGreater(new_metrics['rejected_bytes'], metrics['rejected_bytes'])
+
+    def test_limits_per_format(self):
+        """
+        Formats without their own limits should take the default ones
+        """
+        with override_settings(IMAGE_PROBE_LIMITS=self.limits):
+            limits = image_probe.get_limits('PNG')
+            self.assertEqual(limits, {'max_bytes': 0, 'max_pixels': 1000 * 1000, 'max_frames': 1})
+            response = self._upload(_create_big_image('JPEG', size=(1500, 1000)))
+        self.assertEqual(response.status_code, 200)
+        _remove_temporary_image(temporary_images.get_path(response.json()['file_name']))
+
+    def test_downscale_plan(self):
+        """
+        Plan should have size of image after downscale, known from the header
+        """
+        file = _create_big_image('JPEG', size=(4000, 3000))
+        file.size = len(file.getvalue())
+        image, plan = image_probe.probe(file, (1000, 1000))
+        self.assertEqual(plan['size'], (1000, 750))
+        self.assertEqual((plan['format'], plan['width'], plan['height'], plan['frames']), ('JPEG', 4000, 3000, 1))
+        self.assertIsNone(image.im)  # Not decoded yet
+
+
+class TestTemporaryImagesDeduplication(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.file_names = []
+
+    def tearDown(self):
+        for file_name in self.file_names:
+            temporary_images.remove(file_name)
+        cache.clear()
+
+    def _upload(self, path, **data):
+        with open(path, mode='rb') as file:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        data={'img': file, **data},
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        file_name = response.json()['file_name']
+        self.file_names.append(file_name)
+        return response.json()
+
+    def test_identical_uploads(self):
+        """
+        Identical uploads should be stored once, referenced twice and rendered once
+        """
+        result_1 = self._upload('_images/test/test_img_good.jpg')
+        with mock.patch.object(ascii_generators.PreparedImage, 'open') as prepared_image_open:
+            result_2 = self._upload('_images/test/test_img_good.jpg')
+        prepared_image_open.assert_not_called()
+        self.assertEqual(result_1, result_2)
+        self.assertTrue(temporary_images.is_content_name(result_1['file_name']))
+        self.assertEqual(temporary_images.get_references(result_1['file_name']), 2)
+        shard = os.path.dirname(temporary_images.get_path(result_1['file_name']))
+        stored = [name for name in os.listdir(shard) if name.startswith(result_1['file_name'])]
+        self.assertEqual(len(stored), 3)  # Image, its raw planes and sidecar
+
+    def test_release_previous_image(self):
+        """
+        Image should be kept when the last reference to it is released, and removed with its sidecars by clean()
+        after TTL
+        """
+        file_name_1 = self._upload('_images/test/test_img_good.jpg')['file_name']
+        self._upload('_images/test/test_img_good.jpg')
+        file_name_2 = self._upload('_images/test/w3c_home.png', previous_file_name=file_name_1)['file_name']
+        self.assertNotEqual(file_name_1, file_name_2)
+        self._upload('_images/test/w3c_home.png', previous_file_name=file_name_1)
+        self._upload('_images/test/w3c_home.png', previous_file_name=file_name_1)  # Released more than referenced
+        self.assertEqual(temporary_images.get_references(file_name_1), 0)
+        self.assertEqual(temporary_images.get_references(file_name_2), 3)
+        path_1 = temporary_images.get_path(file_name_1)
+        sidecar_path = image_pipeline.get_sidecar_path(path_1, 1., 1.)
+        self.assertTrue(os.path.exists(path_1))
+        self.assertTrue(os.path.exists(sidecar_path))
+        temporary_images.clean(now=time.time() + settings.TEMPORARY_IMAGES_TTL, max_bytes=0)
+        self.assertFalse(os.path.exists(path_1))
+        self.assertFalse(os.path.exists(sidecar_path))
+        self.assertTrue(os.path.exists(temporary_images.get_path(file_name_2)))
+        # Removed image should be uploaded again by client after 410
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    data={'file_name': file_name_1},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 410)
+
+
+class TestStorage(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sharded_path(self):
+        """
+        Shard should depend only on file name
+        """
+        path = storage.get_sharded_path(self.directory, 'image.jpg')
+        self.assertEqual(path, storage.get_sharded_path(self.directory, 'image.jpg'))
+        self.assertEqual(os.path.relpath(path, self.directory), storage.get_sharded_name('image.jpg'))
+        self.assertRegex(storage.get_sharded_name('image.jpg'), r'^[0-9a-f]{2}/[0-9a-f]{2}/image\.jpg$')
+
+    def test_resolve(self):
+        """
+        Files saved before sharding should still be found, sharded ones first
+        """
+        self.assertIsNone(storage.resolve(self.directory, 'image.jpg'))
+        flat_path = os.path.join(self.directory, 'image.jpg')
+        open(flat_path, mode='wb').close()
+        self.assertEqual(storage.resolve(self.directory, 'image.jpg'), flat_path)
+        sharded_path = storage.get_sharded_path(self.directory, 'image.jpg')
+        os.makedirs(os.path.dirname(sharded_path))
+        open(sharded_path, mode='wb').close()
+        self.assertEqual(storage.resolve(self.directory, 'image.jpg'), sharded_path)
+
+    def test_link_exclusive(self):
+        """
+        Existing file should never be overwritten, source file should be removed anyway
+        """
+        path = os.path.join(self.directory, 'image.jpg')
+        for content, expected in ((b'first', True), (b'second', False)):
+            source_path = os.path.join(self.directory, '.tmp_image.jpg')
+            with open(source_path, mode='wb') as file:
+                file.write(content)
+            self.assertEqual(storage.link_exclusive(source_path, path), expected)
+            self.assertFalse(os.path.exists(source_path))
+        with open(path, mode='rb') as file:
+            self.assertEqual(file.read(), b'first')
+
+    def test_prune_shard(self):
+        """
+        Shard subdirectories left empty should be removed, the ones with other files should be kept
+        """
+        shard_1 = storage.get_shard('image_1.jpg')
+        # Image in the same top level shard, but in another subdirectory of it
+        name_2 = next(f'image_{i}.jpg' for i in range(2, 100000)
+                      if storage.get_shard(f'image_{i}.jpg') != shard_1
+                      and storage.get_shard(f'image_{i}.jpg').split('/')[0] == shard_1.split('/')[0])
+        path_1 = storage.get_sharded_path(self.directory, 'image_1.jpg')
+        path_2 = storage.get_sharded_path(self.directory, name_2)
+        for path in (path_1, path_2):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        os.remove(path_1)
+        storage.prune_shard(self.directory, 'image_1.jpg')
+        self.assertFalse(os.path.exists(os.path.dirname(path_1)))
+        self.assertTrue(os.path.exists(path_2))
+        os.remove(path_2)
+        storage.prune_shard(self.directory, name_2)
+        storage.prune_shard(self.directory, 'image_1.jpg')  # Already removed
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestTemporaryImagesJanitor(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.settings_override = override_settings(TEMPORARY_IMAGES=self.directory, TEMPORARY_IMAGES_TTL=100,
+                                                   TEMPORARY_IMAGES_MAX_BYTES=0)
+        self.settings_override.enable()
+        self.now = time.time()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.directory)
+        cache.clear()
+
+    def _create(self, file_name, size, age):
+        path = os.path.join(self.directory, file_name)
+        with open(path, mode='wb') as file:
+            file.write(b'0' * size)
+        os.utime(path, (self.now - age, self.now - age))
+
+    def test_expired(self):
+        """
+        Only images without references and not accessed for TTL should expire, with their sidecars
+        """
+        self._create('old.jpg', 10, 200)
+        self._create('old.jpg.1.0_1.0.sat.npy', 5, 200)
+        self._create('referenced.jpg', 10, 200)
+        self._create('new.png', 10, 50)
+        self._create('new.png.1.3_0.7.sat.npy', 5, 50)
+        temporary_images.add_reference('referenced.jpg')
+        report = temporary_images.clean(now=self.now)
+        self.assertEqual(report, {
+            'expired': 1, 'evicted': 0, 'orphaned': 0, 'removed_files': 2, 'removed_bytes': 15,
+            'remaining_images': 2, 'remaining_bytes': 25,
+        })
+        self.assertEqual(sorted(os.listdir(self.directory)), ['new.png', 'new.png.1.3_0.7.sat.npy', 'referenced.jpg'])
+
+    def test_touched_image_not_expired(self):
+        """
+        Accessed image should not expire
+        """
+        self._create('image.jpg', 10, 200)
+        temporary_images.touch('image.jpg')
+        self.assertEqual(temporary_images.clean(now=self.now)['expired'], 0)
+
+    def test_bytes_budget(self):
+        """
+        Least recently accessed images should be evicted over the budget, even if they are referenced
+        """
+        for age, file_name in enumerate(('a.jpg', 'b.jpg', 'c.jpg', 'd.jpg')):
+            self._create(file_name, 10, age)
+            temporary_images.add_reference(file_name)
+        report = temporary_images.clean(now=self.now, max_bytes=25)
+        self.assertEqual(report['evicted'], 2)
+        self.assertEqual(report['remaining_bytes'], 20)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.jpg', 'b.jpg'])
+
+    def test_orphans_and_temporary_files(self):
+        """
+        Sidecars without image and temporary files left by interrupted writes should be removed
+        """
+        self._create('gone.jpg.1.0_1.0.sat.npy', 5, 0)
+        self._create('.tmp_123_image.jpg', 7, 200)
+        self._create('.tmp_124_image.jpg', 7, 0)  # Still could be written
+        self._create('.keep', 0, 200)
+        report = temporary_images.clean(now=self.now)
+        self.assertEqual(report['orphaned'], 1)
+        self.assertEqual(report['removed_bytes'], 12)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['.keep', '.tmp_124_image.jpg'])
+
+    def test_sharded_and_flat_images(self):
+        """
+        Images in shards and images saved before sharding should be cleaned alike
+        """
+        self._create('flat.jpg', 10, 200)
+        sharded_path = temporary_images.get_path('sharded.jpg')
+        os.makedirs(os.path.dirname(sharded_path))
+        self._create(os.path.relpath(sharded_path, self.directory), 10, 200)
+        self._create(os.path.relpath(sharded_path, self.directory) + '.1.0_1.0.sat.npy', 5, 200)
+        self.assertEqual(temporary_images.resolve('flat.jpg'), os.path.join(self.directory, 'flat.jpg'))
+        self.assertEqual(temporary_images.resolve('sharded.jpg'), sharded_path)
+        report = temporary_images.clean(now=self.now)
+        self.assertEqual(report['expired'], 2)
+        self.assertEqual(report['removed_bytes'], 25)
+        self.assertIsNone(temporary_images.resolve('sharded.jpg'))
+
+    def test_command(self):
+        """
+        Command should clean images, report it and keep the report for staff metrics
+        """
+        self._create('old.jpg', 10, self.now)
+        self._create('new.jpg', 10, 0)
+        self._create('newest.jpg', 10, -1)
+        output = io.StringIO()
+        call_command('clean_temporary_images', '--max-bytes', '15', stdout=output)
+        self.assertIn('Expired images: 1, evicted images: 1', output.getvalue())
+        self.assertIn('Removed files: 2, removed bytes: 20', output.getvalue())
+        self.assertEqual(os.listdir(self.directory), ['newest.jpg'])
+        self.assertEqual(temporary_images.get_janitor_report()['remaining_bytes'], 10)
+
+    def test_scheduler(self):
+        """
+        In-process scheduler should run janitor periodically
+        """
+        self._create('old.jpg', 10, 200)
+        with mock.patch.object(temporary_images, 'run_janitor') as run_janitor:
+            stopped = temporary_images.start_janitor(0.01)
+            for unused_i in range(100):
+                if run_janitor.called:
+                    break
+                time.sleep(0.01)
+            stopped.set()
+        self.assertTrue(run_janitor.called)
+
+
+class TestImg2Ascii2Engine(TestCase):
+
+    def test_byte_identical_to_reference(self):
+        """
+        Vectorized engine should return exactly the same arts as the old per-cell loop for every mode
+        """
+        cases = (
+            ('_images/test/test_img_good.jpg', (1, 7, 90, 125, 157)),
+            ('_images/test/w3c_home.png', (3, 33, 72)),
+            ('_images/test/WEBP.webp', (90, 300)),
+        )
+        for path, num_cols_list in cases:
+            for num_cols in num_cols_list:
+                for mode in ('simple', 'bars', 'complex'):
+                    for brightness, contrast in ((None, None), (1.5, 0.4), (2., 5.)):
+                        self.assertEqual(
+                            img2ascii_2.image_to_ascii(path, num_cols=num_cols, mode=mode,
+                                                       brightness=brightness, contrast=contrast),
+                            _reference_img2ascii_2(path, num_cols, mode, brightness=brightness, contrast=contrast),
+                        )
+
+
+def _reference_img2ascii_1_do(image, new_width):
+    """
+    Original per-pixel mapping of img2ascii_1, used to check the buffer-based one
+    """
+    image = img2ascii_1.resize(image, new_width).convert('L')
+    pixels = ''.join([img2ascii_1.ASCII_CHARS[pixel_value // 25] for pixel_value in list(image.getdata())])
+    return '\n'.join([pixels[index:index + new_width] for index in range(0, len(pixels), new_width)])
+
+
+class TestImg2Ascii1Engine(TestCase):
+
+    def test_same_as_reference(self):
+        """
+        Buffer-based mapping should return exactly the same arts as the per-pixel one
+        """
+        for path in ('_images/test/test_img_good.jpg', '_images/test/w3c_home.png', '_images/test/WEBP.webp'):
+            rgb = np.array(Image.open(path).convert('RGB'))
+            for num_cols in (4, 5, 33, 90, 300):
+                self.assertEqual(img2ascii_1.rgb_to_ascii(rgb, num_cols),
+                                 _reference_img2ascii_1_do(Image.fromarray(rgb, mode='RGB'), num_cols))
+
+    def test_same_as_original_pipeline(self):
+        """
+        With default settings, arts of image file and of prepared image should be the same as the original
+        img2ascii_1 made: image resized first and converted to grayscale after
+        """
+        path = '_images/test/test_img_good.jpg'
+        for num_cols in (5, 90, 300):
+            expected = _reference_img2ascii_1_do(Image.open(path), num_cols)
+            self.assertEqual(img2ascii_1.image_to_ascii(path, num_cols), expected)
+            self.assertEqual(img2ascii_1.image_to_ascii(path, num_cols, brightness=1., contrast=1.), expected)
+            self.assertEqual(image_pipeline.PreparedImage.open(path, brightness=1., contrast=1.).to_ascii_1(num_cols),
+                             expected)
+
+
+class TestImg2AsciiColor(TestCase):
+    def test_same_characters(self):
+        """
+        Coloured arts without markup should be equal to monochrome img2ascii_2 art
+        """
+        for path, num_cols in (('_images/test/test_img_good.jpg', 90), ('_images/test/w3c_home.png', 50)):
+            for brightness, contrast in ((None, None), (1.3, 0.7)):
+                art = img2ascii_2.image_to_ascii(path, num_cols=num_cols, brightness=brightness, contrast=contrast)
+                art_html = img2ascii_color.image_to_ascii(path, num_cols=num_cols, output='html',
+                                                          brightness=brightness, contrast=contrast)
+                art_ansi = img2ascii_color.image_to_ascii(path, num_cols=num_cols, output='ansi',
+                                                          brightness=brightness, contrast=contrast)
+                self.assertEqual(html.unescape(re.sub(r'<[^>]*>', '', art_html)), art)
+                self.assertEqual(re.sub(r'\x1b\[[0-9;]*m', '', art_ansi), art)
+
+    def test_color_means(self):
+        """
+        Colour of every cell should be mean RGB of its pixels, quantized
+        """
+        pixels = np.array(Image.open('_images/test/w3c_home.png').convert('RGB'))
+        planes = img2ascii_color.get_planes(pixels)
+        cell_means = img2ascii_2.get_cell_means(planes, 20)
+        height, width, cell_width, cell_height, num_rows = img2ascii_2.get_sizes(pixels, 20)
+        for row, col in ((0, 0), (num_rows // 2, 7), (num_rows - 1, 19)):
+            cell = pixels[int(row * cell_height):min(int((row + 1) * cell_height), height),
+                          int(col * cell_width):min(int((col + 1) * cell_width), width)]
+            np.testing.assert_allclose(cell_means[row, col, 1:], cell.reshape(-1, 3).mean(axis=0))
+        self.assertEqual(img2ascii_color.quantize(np.array([0, 63.9, 64, 255])).tolist(), [0, 0, 1, 3])
+
+    def test_runs(self):
+        """
+        Runs of cells with the same colour should share one span, spaces should not break runs
+        """
+        cell_means = np.array([[[0, 255, 0, 0], [0, 250, 10, 0], [255, 0, 0, 255], [0, 0, 255, 0]]], dtype=float)
+        self.assertEqual(
+            img2ascii_color.cells_to_color_ascii(cell_means, '@ '),
+            '<span style=color:#f00>@@ </span><span style=color:#0f0>@</span>\n'
+        )
+        self.assertEqual(
+            img2ascii_color.cells_to_color_ascii(cell_means, '@ ', output='ansi'),
+            '\x1b[38;5;196m@@ \x1b[38;5;46m@\x1b[0m\n'
+        )
+
+    def test_view(self):
+        """
+        Generator should add coloured art when it's asked for
+        """
+        with open('_images/test/test_img_good.jpg', mode='rb') as file:
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'img': file, 'num_cols': 70, 'color': 'html'})
+        json_content = response.json()
+        file_path = temporary_images.get_path(json_content['file_name'])
+        source_path = '_images/test/test_img_good.jpg'
+        self.assertEqual(json_content['color_art'], img2ascii_color.image_to_ascii(source_path, num_cols=70))
+        self.assertEqual(json_content['arts'][2], img2ascii_2.image_to_ascii(source_path, num_cols=70))
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'file_name': json_content['file_name'], 'num_cols': 70})
+        self.assertNotIn('color_art', response.json())
+        _remove_temporary_image(file_path)
+
+
+class TestTxt2Ascii2(TestCase):
+
+    def test_same_as_text2art(self):
+        """
+        Single pass renderer should give exactly the same arts as text2art for every font,
+        including spaces of "block" font, reversed "mirror" fonts, letter case and empty lines
+        """
+        for text in ('Hello World', 'ab\n\ncd\n', 'Tab\tbed  sp ace', 'ÄÖü ß İ 你好', '!?@#$%^&*()_+-=[]{};:",./<>', ''):
+            arts = txt2ascii_2.text2arts(text)
+            self.assertEqual([font for font, unused_art in arts], txt2ascii_1.FONT_NAMES)
+            for font, art in arts:
+                self.assertEqual(art, txt2ascii_1.text2art(text=text, font=font), (text, font))
+
+    def test_normalize(self):
+        """
+        Normalized text should be rendered exactly like the original one
+        """
+        for text, normalized in (('a\r\nb', 'a\nb'), ('\t\n\u200bx', '\t\nx'), ('ß\tİ 你好', 'ßİ '), ('abc', 'abc')):
+            self.assertEqual(txt2ascii_2.normalize(text), normalized)
+            self.assertEqual(txt2ascii_2.text2arts(text), txt2ascii_2.text2arts(normalized))
+
+    def test_select_fonts(self):
+        """
+        Fonts skipped by their metrics should be only those, which arts are discarded as too small
+        """
+        for text, lines in (('Hello World', 1), ('Hello\nWorld', 2), ('Привет\nмир', 2), ('a\n\nb\n', 4), ('', 1)):
+            results = ascii_generators._render_text(text, lines)
+            with mock.patch.object(txt2ascii_2, 'select_fonts', return_value=txt2ascii_2.get_font_names()):
+                self.assertEqual(results, ascii_generators._render_text(text, lines), text)
+        self.assertLess(len(txt2ascii_2.select_fonts('Hello World', 4)), len(txt2ascii_2.get_font_names()))
+        self.assertEqual(txt2ascii_2.select_fonts('Привет\nмир', 7), [])  # Nothing to render
+
+    def test_rank_fonts(self):
+        """
+        Fonts without glyphs for visible characters should be skipped, fonts covering only some of them should go last
+        """
+        self.assertEqual(txt2ascii_2.rank_fonts('a123', ['alpha', 'standard']), ['standard', 'alpha'])
+        self.assertEqual(txt2ascii_2.rank_fonts('a123', ['alpha', 'standard'], min_coverage=0.2), ['alpha', 'standard'])
+        self.assertEqual(txt2ascii_2.rank_fonts('Привет мир', ['alpha', 'standard']), [])
+        self.assertEqual(txt2ascii_2.rank_fonts(' \n ', ['alpha', 'standard']), ['alpha', 'standard'])
+        self.assertEqual(txt2ascii_2.get_coverage(Counter('aбв'), txt2ascii_2.get_catalog()['standard']['coverage']),
+                         1 / 3)
+
+    def test_non_latin_text(self):
+        """
+        Text generator should not render blank arts of text that fonts have no glyphs for
+        """
+        response = self.client.post(reverse('text_to_ascii_generator_url'), data={'txt': 'Привет мир'},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('text_to_ascii_generator_url'), data={'txt': 'Привет world'},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        for font, art in response.json()['results']:
+            self.assertTrue(art.strip(), font)
+
+    def test_catalog(self):
+        """
+        Catalog should have metrics of every font without its glyphs
+        """
+        catalog = txt2ascii_2.get_catalog()
+        self.assertEqual(list(catalog), txt2ascii_2.get_font_names())
+        self.assertEqual(catalog['block'], {
+            'height': 13, 'width': 20, 'average_width': catalog['block']['average_width'], 'ascii_only': True,
+            'coverage': catalog['block']['coverage'], 'case': 'lower', 'block': True, 'mirror': False,
+        })
+        self.assertTrue(txt2ascii_2.is_covered(catalog['block']['coverage'], 'a'))
+        self.assertFalse(txt2ascii_2.is_covered(catalog['block']['coverage'], ' '))  # Skipped by "block"
+        self.assertFalse(txt2ascii_2.is_covered(catalog['block']['coverage'], 'б'))
+        self.assertLessEqual(catalog['block']['average_width'], catalog['block']['width'])
+
+    def test_compiled_font(self):
+        """
+        Glyphs should be split into rows once, skipped characters should be left out
+        """
+        font = txt2ascii_2.get_font('block')
+        self.assertNotIn(' ', font['glyphs'])
+        self.assertEqual(font['glyphs']['a'], tuple(txt2ascii_1.FONT_MAP['block'][0]['a'].split('\n')))
+        self.assertEqual(font['height'], 13)
+        self.assertTrue(font['block'])
+        self.assertTrue(txt2ascii_2.get_font('mirror')['mirror'])
+
+
+class TestFontPack(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fonts', 'fonts.pack')
+        self.settings_override = override_settings(FONT_PACK_PATH=self.path)
+        self.settings_override.enable()
+        txt2ascii_2.reset()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.directory)
+        txt2ascii_2.reset()
+
+    def test_same_as_compiled_fonts(self):
+        """
+        Fonts loaded from font pack should be the same as compiled fonts, and give the same arts
+        """
+        compiled_source = txt2ascii_2.get_source()
+        arts = txt2ascii_2.text2arts('Font pack\nTest')
+        output = io.StringIO()
+        call_command('build_font_pack', stdout=output)
+        self.assertIn(self.path, output.getvalue())
+        txt2ascii_2.reset()
+        source = txt2ascii_2.get_source()
+        self.assertIsInstance(source, font_pack.FontPack)
+        self.assertEqual(source.names, compiled_source.names)
+        self.assertEqual(source.version, compiled_source.version)
+        self.assertEqual(source.rendered_chars, compiled_source.rendered_chars)
+        self.assertEqual(source.catalog, compiled_source.catalog)
+        for font_name in ('block', 'mirror', txt2ascii_1.UPPERCASE_FONTS[0], txt2ascii_1.DEFAULT_FONT):
+            self.assertEqual(source.load(font_name), compiled_source.load(font_name))
+        self.assertEqual(txt2ascii_2.text2arts('Font pack\nTest'), arts)
+
+    def test_lazy_load(self):
+        """
+        Only fonts that are used should be decoded
+        """
+        txt2ascii_2.build_font_pack(self.path)
+        with mock.patch.object(font_pack, '_decode_font', wraps=font_pack._decode_font) as decode_font:
+            self.assertEqual(txt2ascii_2.text2art('ab', 'block'), txt2ascii_1.text2art('ab', font='block'))
+            txt2ascii_2.text2art('abc', 'block')
+        decode_font.assert_called_once()
+
+    def test_wrong_file(self):
+        """
+        File that is not a font pack should not be loaded
+        """
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, mode='wb') as file:
+            file.write(b'0' * 100)
+        with self.assertRaises(font_pack.FontPackError):
+            txt2ascii_2.get_source()
+
+
+class TestEnhanceLUT(TestCase):
+
+    def test_same_as_image_enhance(self):
+        """
+        Lookup table should give exactly the same grayscale plane as ImageEnhance.Contrast and Brightness
+        """
+        planes = (
+            np.arange(256, dtype=np.uint8).reshape(16, 16),
+            np.array(Image.open('_images/test/test_img_good.jpg').convert('L')),
+            np.array(Image.open('_images/test/WEBP.webp').convert('L')),
+        )
+        factors = (None, 0., 0.25, 0.5, 1., 1.2, 1.7, 2., 5.)
+        for plane in planes:
+            for brightness in factors:
+                for contrast in factors:
+                    image = Image.fromarray(plane, mode='L')
+                    if contrast is not None:
+                        image = ImageEnhance.Contrast(image).enhance(contrast)
+                    if brightness is not None:
+                        image = ImageEnhance.Brightness(image).enhance(brightness)
+                    np.testing.assert_array_equal(
+                        enhance.enhance_plane(plane, brightness=brightness, contrast=contrast), np.array(image)
+                    )
+
+    def test_colour_image_same_as_image_enhance(self):
+        """
+        Colour image should be enhanced exactly like ImageEnhance does it, contrast is blending with the mean
+        of PIL's grayscale, not of the grayscale of arts
+        """
+        factors = ((None, 1.5), (0.8, 1.3), (2., 5.), (1.2, None))
+        for path in ('_images/test/test_img_good.jpg', '_images/test/WEBP.webp'):
+            image = Image.open(path).convert('RGB')
+            pixels = np.array(image)
+            for brightness, contrast in factors:
+                enhanced = image
+                if contrast is not None:
+                    enhanced = ImageEnhance.Contrast(enhanced).enhance(contrast)
+                if brightness is not None:
+                    enhanced = ImageEnhance.Brightness(enhanced).enhance(brightness)
+                np.testing.assert_array_equal(enhance.enhance_pixels(pixels, brightness=brightness, contrast=contrast),
+                                              np.array(enhanced))
+                prepared_image = image_pipeline.PreparedImage.open(path, brightness=brightness, contrast=contrast)
+                np.testing.assert_array_equal(prepared_image.gray,
+                                              cv2.cvtColor(np.array(enhanced), cv2.COLOR_BGR2GRAY))
+
+
+def _reference_calculate_num_cols(width, height, num_cols):
+    """
+    Original recursive calculation of num_cols, used to check the closed-form one
+    """
+    cell_width = width / num_cols
+    cell_height = 2 * cell_width
+    num_rows = int(height / cell_height)
+    if num_cols > width or num_rows > height:
+        num_cols -= 1
+        num_cols = _reference_calculate_num_cols(width, height, num_cols)
+    return num_cols
+
+
+class TestCalculateNumCols(TestCase):
+
+    def test_same_as_reference(self):
+        """
+        Closed-form num_cols should be the same as the recursive one for every width, height and num_cols
+        """
+        for width in range(1, 41):
+            for height in range(1, 41):
+                for num_cols in range(1, 61):
+                    self.assertEqual(ascii_generators._calculate_num_cols(width, num_cols),
+                                     _reference_calculate_num_cols(width, height, num_cols))
+        for width, height in ((1, 1), (1, 1000), (1000, 1), (157, 158), (999, 1000), (1000, 1000)):
+            for num_cols in (1, 2, 90, 125, 299, 300):
+                self.assertEqual(ascii_generators._calculate_num_cols(width, num_cols),
+                                 _reference_calculate_num_cols(width, height, num_cols))
+
+    def test_no_recursion_limit(self):
+        """
+        Very high num_cols on tiny image should not hit recursion limit
+        """
+        self.assertEqual(ascii_generators._calculate_num_cols(1, 100000), 1)
+
+
+class TestIntegralImageSidecar(TestCase):
+
+    def setUp(self):
+        self.file_path = os.path.join(
+            settings.TEMPORARY_IMAGES, 'test_image_' + ''.join(random.choices(string.ascii_lowercase, k=10)) + '.jpg'
+        )
+        with open('_images/test/test_img_good.jpg', mode='rb') as file:
+            with open(self.file_path, 'wb') as file_new:
+                file_new.write(file.read())
+
+    def tearDown(self):
+        _remove_temporary_image(self.file_path)
+
+    def test_rerender_without_decoding(self):
+        """
+        Arts at any num_cols should be calculated from memory-mapped sidecar without opening the image
+        """
+        sidecar_path = image_pipeline.get_sidecar_path(self.file_path, 1.2, 0.8)
+        prepared_image = image_pipeline.PreparedImage(self.file_path, brightness=1.2, contrast=0.8,
+                                                      sidecar_path=sidecar_path)
+        arts = [prepared_image.to_ascii(num_cols, mode='simple') for num_cols in (30, 90, 157)]
+        self.assertTrue(os.path.exists(sidecar_path))
+        with mock.patch.object(image_pipeline.Image, 'open', wraps=Image.open) as image_open:
+            prepared_image = image_pipeline.PreparedImage(self.file_path, brightness=1.2, contrast=0.8,
+                                                          sidecar_path=sidecar_path)
+            self.assertEqual([prepared_image.to_ascii(num_cols, mode='simple') for num_cols in (30, 90, 157)], arts)
+            self.assertEqual((prepared_image.width, prepared_image.height), (157, 158))
+        self.assertEqual(image_open.call_count, 0)
+        self.assertIsInstance(prepared_image.integral, np.memmap)
+        self.assertEqual(arts[1], img2ascii_2.image_to_ascii(self.file_path, num_cols=90, mode='simple',
+                                                             brightness=1.2, contrast=0.8))
+
+    def test_raw_planes(self):
+        """
+        Raw planes should be saved on the first decode, then memory-mapped and give the same arts as the image
+        """
+        raw_path = image_pipeline.get_raw_path(self.file_path)
+        prepared_image = image_pipeline.PreparedImage(self.file_path, brightness=1.2, raw_path=raw_path)
+        arts = [prepared_image.to_ascii_1(90), prepared_image.to_color_ascii(90)]
+        self.assertTrue(os.path.exists(raw_path))
+        with mock.patch.object(image_pipeline.Image, 'open', wraps=Image.open) as image_open:
+            prepared_image = image_pipeline.PreparedImage(self.file_path, brightness=1.2, raw_path=raw_path)
+            self.assertEqual([prepared_image.to_ascii_1(90), prepared_image.to_color_ascii(90)], arts)
+            art = prepared_image.to_ascii(90)
+        self.assertEqual(image_open.call_count, 0)
+        self.assertEqual(art, img2ascii_2.image_to_ascii(self.file_path, num_cols=90, brightness=1.2))
+        self.assertIsInstance(prepared_image.raw, np.memmap)
+        self.assertEqual(prepared_image.raw.shape, (158, 157, 4))
+        self.assertEqual(arts[0], img2ascii_1.image_to_ascii(self.file_path, num_cols=90, brightness=1.2))
+
+    def test_sidecar_per_brightness_and_contrast(self):
+        """
+        Changing brightness or contrast should create its own sidecar and keep the others
+        """
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'file_name': os.path.basename(self.file_path)})
+        self.assertEqual(response.status_code, 200)
+        sidecar_path = image_pipeline.get_sidecar_path(self.file_path, 1., 1.)
+        modified = os.path.getmtime(sidecar_path)
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'file_name': os.path.basename(self.file_path), 'brightness': 150})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(os.path.exists(image_pipeline.get_sidecar_path(self.file_path, 1.5, 1.)))
+        self.assertEqual(os.path.getmtime(sidecar_path), modified)
+        self.assertEqual(image_pipeline.remove_sidecars(self.file_path)[0], 3)  # With raw planes
+
+    def test_sidecar_per_whole_percent(self):
+        """
+        Brightness and contrast should be rounded to whole percents and limited, so they share sidecars
+        """
+        for brightness, contrast in (('150.2', '99.6'), ('149.9999', '100.4'), ('150', 'abc')):
+            response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                        HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'file_name': os.path.basename(self.file_path),
+                                              'brightness': brightness, 'contrast': contrast})
+            self.assertEqual(response.json()['brightness'], 150)
+            self.assertEqual(response.json()['contrast'], 100)
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'file_name': os.path.basename(self.file_path),
+                                          'brightness': '1e300', 'contrast': '-5'})
+        self.assertEqual(response.json()['brightness'], ascii_generators.ENHANCE_PERCENT_MAX)
+        self.assertEqual(response.json()['contrast'], 0)
+        self.assertEqual(image_pipeline.remove_sidecars(self.file_path)[0], 3)  # With raw planes
+
+    def test_concurrent_writes(self):
+        """
+        Threads writing the same raw planes at once should all succeed and leave one full file
+        """
+        raw_path = image_pipeline.get_raw_path(self.file_path)
+        raw = image_pipeline.get_raw_planes(Image.open(self.file_path))
+        barrier = threading.Barrier(4)
+        errors = []
+
+        def save():
+            barrier.wait()
+            try:
+                image_pipeline.save_raw(raw_path, Image.open(self.file_path))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=save) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        np.testing.assert_array_equal(np.load(raw_path), raw)
+        directory = os.path.dirname(self.file_path)
+        self.assertFalse([name for name in os.listdir(directory) if name.startswith('.tmp_')])
+
+
+class TestGeneratorPool(TestCase):
+
+    def _render(self, pool, prepared_image, num_cols):
+        cell_means = prepared_image.cell_means(num_cols)
+        with pool.share(cell_means, prepared_image.rgb) as (shared_cell_means, shared_rgb):
+            arts_1_future = pool.submit(ascii_generators._generator_hub_1, shared_cell_means)
+            arts_2_future = pool.submit(ascii_generators._generator_hub_2, shared_cell_means, shared_rgb,
+                                        prepared_image.lut_1, num_cols)
+            return [*arts_1_future.result(), *arts_2_future.result()]
+
+    def test_process_backend_same_as_thread_backend(self):
+        """
+        Process pool should receive grids through shared memory and return the same arts as thread pool
+        """
+        prepared_image = image_pipeline.PreparedImage.open('_images/test/test_img_good.jpg', brightness=1.3)
+        thread_pool = workers.GeneratorPool(backend=workers.BACKEND_THREAD, max_workers=2)
+        process_pool = workers.GeneratorPool(backend=workers.BACKEND_PROCESS, max_workers=2)
+        try:
+            for num_cols in (20, 90, 157):
+                arts = self._render(thread_pool, prepared_image, num_cols)
+                self.assertEqual(len(arts), 4)
+                self.assertEqual(self._render(process_pool, prepared_image, num_cols), arts)
+        finally:
+            thread_pool.shutdown()
+            process_pool.shutdown()
+
+    def test_metrics(self):
+        """
+        Metrics should count busy workers and queued tasks
+        """
+        pool = workers.GeneratorPool(backend=workers.BACKEND_THREAD, max_workers=1, max_queue=2)
+        event = threading.Event()
+        futures = [pool.submit(event.wait) for i in range(3)]
+        metrics = pool.metrics()
+        self.assertEqual(metrics['workers_busy'], 1)
+        self.assertEqual(metrics['queue_depth'], 2)
+        self.assertEqual(metrics['submitted'], 3)
+        event.set()
+        for future in futures:
+            future.result()
+        pool.shutdown()
+        metrics = pool.metrics()
+        self.assertEqual(metrics['workers_busy'], 0)
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['completed'], 3)
+
+    def test_replace_broken_pool(self):
+        """
+        Process pool whose worker died should be replaced by a new one on the next get_pool()
+        """
+        with override_settings(ASCII_GENERATOR_BACKEND=workers.BACKEND_PROCESS, ASCII_GENERATOR_WORKERS=1), \
+                mock.patch.object(workers, '_pool', None):
+            pool = workers.get_pool()
+            try:
+                os.kill(pool.submit(os.getpid).result(), signal.SIGKILL)
+                with self.assertRaises(BrokenProcessPool):
+                    pool.submit(os.getpid).result()
+                self.assertTrue(pool.broken)
+                new_pool = workers.get_pool()
+                self.assertIsNot(new_pool, pool)
+                self.assertIsInstance(new_pool.submit(os.getpid).result(), int)
+                self.assertIs(workers.get_pool(), new_pool)
+            finally:
+                workers.get_pool().shutdown()
+
+
+def _create_animated_gif(num_frames=5, size=(120, 80)):
+    """
+    Create animated gif in memory, frames 1 and 2 differ in a pixel that doesn't change their arts
+    """
+    frames = []
+    for i, index in enumerate((0, 1, 1, 2, 3, 4, 5, 6, 7, 8)[:num_frames]):
+        frame = Image.new('L', size, 255)
+        frame.paste(0, (index * 10, 0, index * 10 + 30, size[1] // 2))
+        frame.putpixel((size[0] - 1, size[1] - 1), 255 - i)  # Otherwise identical frames are merged by PIL
+        frames.append(frame.convert('P'))
+    file = io.BytesIO()
+    frames[0].save(file, 'GIF', save_all=True, append_images=frames[1:], duration=[50, 60, 70, 80, 90][:num_frames],
+                   loop=0)
+    file.seek(0)
+    file.name = 'animated.gif'
+    return file
+
+
+class TestAnimation(TestCase):
+    def _decode(self, sequence):
+        arts = []
+        rows = []
+        for frame in sequence:
+            for index, row in frame['rows']:
+                if index == len(rows):
+                    rows.append(row)
+                rows[index] = row
+            arts.append(('\n'.join(rows), frame['duration']))
+        return arts
+
+    def _reference_arts(self, file, num_cols):
+        arts = []
+        for frame in ImageSequence.Iterator(Image.open(file)):
+            gray = cv2.cvtColor(np.array(frame.convert('RGB')), cv2.COLOR_BGR2GRAY)
+            arts.append(img2ascii_2.cells_to_ascii(img2ascii_2.get_cell_means(gray, num_cols),
+                                                   img2ascii_2.get_char_list('complex')))
+        return arts
+
+    def test_frames(self):
+        """
+        Identical consecutive frames should be merged, other frames should have only changed rows
+        """
+        file = _create_animated_gif()
+        reference_arts = self._reference_arts(file, 40)
+        file.seek(0)
+        result = animation.image_to_ascii_frames(Image.open(file), num_cols=40)
+        self.assertEqual(result['num_cols'], 40)
+        self.assertFalse(result['truncated'])
+        self.assertEqual(len(result['frames']), 4)
+        self.assertEqual(len(result['frames'][0]['rows']), result['num_rows'] + 1)
+        self.assertLess(len(result['frames'][1]['rows']), result['num_rows'])
+        self.assertEqual(self._decode(result['frames']), [
+            (reference_arts[0], 50), (reference_arts[1], 130), (reference_arts[3], 80), (reference_arts[4], 90)
+        ])
+
+    def test_process_backend(self):
+        """
+        Frames rendered in worker processes should be the same
+        """
+        file = _create_animated_gif()
+        result = animation.image_to_ascii_frames(Image.open(file), num_cols=30)
+        file.seek(0)
+        process_pool = workers.GeneratorPool(backend=workers.BACKEND_PROCESS, max_workers=2)
+        try:
+            with mock.patch.object(workers, 'get_pool', return_value=process_pool), \
+                    mock.patch.object(animation, 'FRAMES_PER_TASK', 2):
+                self.assertEqual(animation.image_to_ascii_frames(Image.open(file), num_cols=30), result)
+        finally:
+            process_pool.shutdown()
+
+    @override_settings(ANIMATION_MAX_FRAMES=3, ANIMATION_MAX_PIXELS=3 * 60 * 40)
+    def test_budget(self):
+        """
+        Frames over the budget should be dropped and the rest downscaled to fit into pixels budget
+        """
+        frames, durations, truncated = animation.load_frames(Image.open(_create_animated_gif()))
+        self.assertEqual(frames.shape, (3, 40, 60))
+        self.assertEqual(durations, [50, 60, 70])
+        self.assertTrue(truncated)
+
+    def test_view(self):
+        """
+        Uploaded animated gif should be rendered frame by frame only if it's asked for
+        """
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'img': _create_animated_gif(), 'num_cols': 50, 'animate': 1})
+        self.assertEqual(response.status_code, 200)
+        json_content = response.json()
+        self.assertEqual(len(json_content['arts']), 4)
+        self.assertEqual(len(json_content['animation']['frames']), 4)
+        self.assertEqual(json_content['animation']['num_cols'], 50)
+        response = self.client.post(reverse('image_to_ascii_generator_url'),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    data={'img': _create_animated_gif(), 'num_cols': 50})
+        self.assertNotIn('animation', response.json())
+        _remove_temporary_image(temporary_images.get_path(json_content['file_name']))
 
 
 class TestTextToAsciiGeneratorView(TestCase):
@@ -514,6 +1687,258 @@ class TestTextToAsciiGeneratorView(TestCase):
         self.assertEqual(response.status_code, 400)
 
 
+class TestGeneratorsAdmission(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    @override_settings(GENERATORS_PROCESS_LIMIT=1, GENERATORS_RETRY_AFTER=7)
+    def test_view_over_process_limit(self):
+        """
+        Generator views should return 503 with Retry-After when all slots are taken
+        """
+        rejected = generators_limiter.metrics()['rejected']
+        self.assertTrue(generators_limiter.acquire())
+        try:
+            for url in ('text_to_ascii_generator_url', 'image_to_ascii_generator_url'):
+                response = self.client.post(reverse(url), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response['Retry-After'], '7')
+            self.assertEqual(generators_limiter.metrics()['in_flight'], 1)
+            self.assertEqual(generators_limiter.metrics()['rejected'], rejected + 2)
+        finally:
+            generators_limiter.release()
+        response = self.client.post(reverse('text_to_ascii_generator_url'), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(generators_limiter.metrics()['in_flight'], 0)
+
+    @override_settings(GENERATORS_PROCESS_LIMIT=10, GENERATORS_GLOBAL_LIMIT=2)
+    def test_global_limit(self):
+        """
+        Processes sharing the cache should share global limit, and released slots should be reusable
+        """
+        limiter_1 = ConcurrencyLimiter('test')
+        limiter_2 = ConcurrencyLimiter('test')  # Same as limiter of another process
+        self.assertTrue(limiter_1.acquire())
+        self.assertTrue(limiter_2.acquire())
+        self.assertFalse(limiter_1.acquire())
+        metrics = limiter_1.metrics()
+        self.assertEqual(metrics['in_flight'], 1)
+        self.assertEqual(metrics['rejected'], 1)
+        self.assertEqual(metrics['in_flight_global'], 2)
+        self.assertEqual(metrics['rejected_global'], 1)
+        limiter_2.release()
+        self.assertTrue(limiter_1.acquire())
+        limiter_1.release()
+        limiter_1.release()
+        self.assertEqual(limiter_1.metrics()['in_flight_global'], 0)
+
+    @override_settings(GENERATORS_PROCESS_LIMIT=10, GENERATORS_GLOBAL_LIMIT=1)
+    def test_global_counter_expired(self):
+        """
+        Expired global counter should not block or go negative
+        """
+        limiter = ConcurrencyLimiter('test')
+        self.assertTrue(limiter.acquire())
+        cache.delete(limiter._cache_key('in_flight'))
+        limiter.release()
+        self.assertEqual(cache.get(limiter._cache_key('in_flight')), 0)
+        self.assertTrue(limiter.acquire())
+        limiter.release()
+
+
+class TestLargeValueCache(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_small_value(self):
+        """
+        Small value should be stored compressed in one item
+        """
+        value = {'arts': ['a' * 10000, 'b' * 10000]}
+        self.assertTrue(caching.set_large('test_key', value))
+        self.assertIsInstance(cache.get('test_key'), tuple)
+        self.assertEqual(caching.get_large('test_key'), value)
+        self.assertIsNone(caching.get_large('test_key_missing'))
+
+    @override_settings(CACHE_CHUNK_SIZE=1000)
+    def test_chunked_value(self):
+        """
+        Big value should be split into chunks, which are fetched with one get_many
+        """
+        value = {'arts': [os.urandom(5000)]}  # Not compressible
+        chunked_sets = caching.get_metrics()['chunked_sets']
+        self.assertTrue(caching.set_large('test_key', value))
+        self.assertEqual(caching.get_metrics()['chunked_sets'], chunked_sets + 1)
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            self.assertEqual(caching.get_large('test_key'), value)
+        self.assertEqual(get_many.call_count, 1)
+        # Value with evicted chunk is a miss
+        unused_kind, version, num_chunks = cache.get('test_key')
+        self.assertEqual(num_chunks, 6)
+        cache.delete(caching._get_chunk_key('test_key', version, 3))
+        self.assertEqual(caching.get_large('test_key', 'default'), 'default')
+
+    def test_old_value(self):
+        """
+        Values cached in the old format under the same key should be a miss, and be replaced by new ones
+        """
+        for old_value in ({'arts': ['a']}, [['font', 'art']], ('a', 'b'), (), 'value', 0):
+            cache.set('test_key', old_value)
+            self.assertEqual(caching.get_large('test_key', 'default'), 'default')
+        self.assertEqual(caching.get_or_set_single_flight('test_key', lambda: {'arts': ['b']}, 60), {'arts': ['b']})
+        self.assertEqual(caching.get_large('test_key'), {'arts': ['b']})
+
+    def test_set_failure(self):
+        """
+        Values that cache refused to store should be counted
+        """
+        set_failures = caching.get_metrics()['set_failures']
+        with mock.patch.object(cache, 'set_many', return_value=['test_key']):
+            self.assertFalse(caching.set_large('test_key', 'value'))
+        self.assertEqual(caching.get_metrics()['set_failures'], set_failures + 1)
+        self.assertIsNone(caching.get_large('test_key'))
+
+    @override_settings(CACHE_CHUNK_SIZE=100000)
+    def test_detail_view_cached(self):
+        """
+        Shared object with many big arts should be taken from the cache on second request
+        """
+        obj = GeneratedASCII.objects.create(preferred_output_method='testing123')
+        TextToASCIIType.objects.create(generated_ascii=obj, input_text='Hello World', multi_line_mode=False)
+        obj.output_ascii = json.dumps([{'method_name': str(i), 'ascii_txt': os.urandom(4000).hex()}
+                                       for i in range(200)])
+        obj.save()
+        chunked_sets = caching.get_metrics()['chunked_sets']
+        self.client.get(reverse('ascii_detail_url', kwargs={'ascii_url_code': obj.url_code}))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('ascii_detail_url', kwargs={'ascii_url_code': obj.url_code}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(caching.get_metrics()['chunked_sets'], chunked_sets + 1)
+        obj.delete()
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_threads_coalesced(self):
+        """
+        Identical concurrent calls in one process should compute value once
+        """
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        def call():
+            results.append(caching.get_or_set_single_flight('test_key', compute))
+
+        coalesced = caching.get_metrics()['coalesced']
+        threads = [threading.Thread(target=call) for unused_i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(caching.get_metrics()['coalesced'], coalesced + 4)
+        self.assertEqual(caching.get_large('test_key'), 'value')
+
+    def test_other_process_leader(self):
+        """
+        Call should wait for result of another process holding the lock
+        """
+        cache.add('test_key_lock', 1)
+        timer = threading.Timer(0.2, caching.set_large, args=('test_key', 'value'))
+        timer.start()
+        compute = mock.Mock(return_value='other value')
+        self.assertEqual(caching.get_or_set_single_flight('test_key', compute), 'value')
+        compute.assert_not_called()
+        timer.join()
+
+    def test_other_process_leader_failed(self):
+        """
+        Call should compute value by itself if lock is released without result
+        """
+        cache.add('test_key_lock', 1)
+        timer = threading.Timer(0.2, cache.delete, args=('test_key_lock',))
+        timer.start()
+        compute = mock.Mock(return_value='value')
+        self.assertEqual(caching.get_or_set_single_flight('test_key', compute), 'value')
+        compute.assert_called_once()
+        timer.join()
+
+    def test_text_generator_cached(self):
+        """
+        Identical text request should not be rendered again
+        """
+        data = {'txt': 'single flight'}
+        response_1 = self.client.post(reverse('text_to_ascii_generator_url'), data=data,
+                                      HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        with mock.patch.object(ascii_generators, '_render_text') as render_text:
+            response_2 = self.client.post(reverse('text_to_ascii_generator_url'), data=data,
+                                          HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        render_text.assert_not_called()
+        self.assertEqual(response_1.json(), response_2.json())
+
+    def test_text_generator_local_cache(self):
+        """
+        Text arts should be served from memory of the process, and be shared by texts differing by ignored characters
+        """
+        ascii_generators.text_local_cache.clear()
+        response_1 = self.client.post(reverse('text_to_ascii_generator_url'), data={'txt': 'local\tcache'},
+                                      HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        metrics = caching.get_metrics()
+        with mock.patch.object(ascii_generators, '_render_text') as render_text:
+            response_2 = self.client.post(reverse('text_to_ascii_generator_url'), data={'txt': 'localcache\u200b'},
+                                          HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            response_3 = self.client.post(reverse('text_to_ascii_generator_url'), data={'txt': 'local\tcache'},
+                                          HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        render_text.assert_not_called()
+        self.assertEqual(response_1.json(), response_2.json())
+        self.assertEqual(response_1.json(), response_3.json())
+        self.assertEqual(caching.get_metrics()['local_hits'] - metrics['local_hits'], 2)
+        self.assertEqual(caching.get_metrics()['hits'] - metrics['hits'], 0)
+
+    def test_local_cache_size(self):
+        """
+        Least recently used values should be evicted over the size
+        """
+        local_cache = caching.LocalCache(2)
+        local_cache.set('a', 1)
+        local_cache.set('b', 2)
+        local_cache.get('a')
+        local_cache.set('c', 3)
+        self.assertEqual((local_cache.get('a'), local_cache.get('b'), local_cache.get('c')), (1, None, 3))
+        self.assertEqual(len(local_cache), 2)
+
+    def test_expired_lock_of_other_process_kept(self):
+        """
+        Leader should not release the lock taken by another process after its own lock expired
+        """
+        def compute():
+            cache.set('test_key_lock', 'other', 60)  # Own lock expired and another process took it
+            return 'value'
+
+        self.assertEqual(caching.get_or_set_single_flight('test_key', compute, 60), 'value')
+        self.assertEqual(cache.get('test_key_lock'), 'other')
+        cache.clear()
+        self.assertEqual(caching.get_or_set_single_flight('test_key', lambda: 'value', 60), 'value')
+        self.assertIsNone(cache.get('test_key_lock'))
+
+
 class TestAsciiDetailView(TestCase):
     def test_wrong_ascii_url_code(self):
         """
@@ -602,6 +2027,11 @@ class TestAsciiDetailView(TestCase):
 
 
 class TestAsciiShareView(TestCase):
+    def tearDown(self):
+        _remove_shared_images()
+        if os.path.exists('_images/temporary/test_img_good.jpg'):
+            _remove_temporary_image('_images/temporary/test_img_good.jpg')
+
     def test_non_ajax_requests(self):
         """
         Non-ajax requests should return redirect 302
@@ -732,7 +2162,8 @@ class TestAsciiShareView(TestCase):
         self.assertEqual(image_to_ascii_options.columns, '90')
         self.assertEqual(image_to_ascii_options.brightness, '100')
         self.assertEqual(image_to_ascii_options.contrast, '100')
-        os.remove(image_to_ascii_type.input_image.path)
+        self.assertRegex(image_to_ascii_type.input_image.name, r'^input_images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-z]{20}\.')
+        _remove_shared_image(image_to_ascii_type.input_image.path)
         obj.delete()
 
     def test_ajax_only_image(self):
@@ -773,11 +2204,57 @@ class TestAsciiShareView(TestCase):
         self.assertEqual(image_to_ascii_options.columns, '150')
         self.assertEqual(image_to_ascii_options.brightness, '50')
         self.assertEqual(image_to_ascii_options.contrast, '123')
-        os.remove(image_to_ascii_type.input_image.path)
+        _remove_shared_image(image_to_ascii_type.input_image.path)
         obj.delete()
 
+    def test_ajax_image_encoded_from_raw_planes(self):
+        """
+        Shared image should be encoded again from raw planes with high quality instead of copying lossy preview,
+        lossless previews should be copied as is
+        """
+        for source_path in ('_images/test/test_img_good.jpg', '_images/test/w3c_home.png'):
+            with open(source_path, mode='rb') as file:
+                file_name = self.client.post(reverse('image_to_ascii_generator_url'),
+                                             HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                             data={'img': file}).json()['file_name']
+            path = temporary_images.get_path(file_name)
+            response = self.client.post(reverse('ascii_share_url'), HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'preferred_output_method': '1', 'file_name': file_name})
+            self.assertEqual(response.status_code, 200)
+            image_to_ascii_type = ImageToASCIIType.objects.get(generated_ascii=GeneratedASCII.objects.last())
+            with open(image_to_ascii_type.input_image.path, mode='rb') as file:
+                shared = file.read()
+            if source_path.endswith('.jpg'):
+                self.assertEqual(shared, image_pipeline.encode_raw(image_pipeline.get_raw_path(path), 'JPEG',
+                                                                   **ascii_generators.SHARE_SAVE_PARAMS))
+            else:
+                with open(path, mode='rb') as file:
+                    self.assertEqual(shared, file.read())
+            _remove_shared_image(image_to_ascii_type.input_image.path)
+            _remove_temporary_image(path)
+
+    def test_ajax_image_ignores_batch_and_preview(self):
+        """
+        Ajax POST with options of other renders (batch of widths, progressive preview) should share single render
+        """
+        shutil.copy('_images/test/test_img_good.jpg', '_images/temporary/test_img_good.jpg')
+        for data in ({'num_cols_batch': '40:80:20'}, {'preview_method': '2'}):
+            cache.clear()
+            response = self.client.post(reverse('ascii_share_url'), HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        data={'preferred_output_method': '1', 'file_name': 'test_img_good.jpg',
+                                              'num_cols': 60, **data})
+            self.assertEqual(response.status_code, 200)
+            image_to_ascii_type = ImageToASCIIType.objects.get(generated_ascii=GeneratedASCII.objects.last())
+            self.assertEqual(image_to_ascii_type.options.columns, '60')
+            _remove_shared_image(image_to_ascii_type.input_image.path)
+
 
 class TestAsciiReportView(TestCase):
+    def tearDown(self):
+        _remove_shared_images()
+        if os.path.exists('_images/temporary/test_img_good.jpg'):
+            _remove_temporary_image('_images/temporary/test_img_good.jpg')
+
     def _create_ascii_obj(self):
         file = open('_images/test/test_img_good.jpg', mode='rb')
         with open('_images/temporary/test_img_good.jpg', mode='wb') as file_new:
@@ -793,7 +2270,7 @@ class TestAsciiReportView(TestCase):
 
     def _delete_ascii_obj(self, obj):
         image_to_ascii_type = ImageToASCIIType.objects.get(generated_ascii=obj)
-        os.remove(image_to_ascii_type.input_image.path)
+        _remove_shared_image(image_to_ascii_type.input_image.path)
         image_to_ascii_type.delete()
 
     def test_non_ajax(self):
@@ -1,9 +1,9 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 
 from app.services import ReportService, FeedbackService, GeneratedASCIIService
 from app.ascii_generators import ascii_generators
-from app.decorators import redirect_if_not_ajax
+from app.decorators import redirect_if_not_ajax, limit_concurrency, generators_limiter
 
 
 def handler400_view(request, *args, **kwargs):
@@ -75,16 +75,18 @@ def feedback(request):
 
 
 @redirect_if_not_ajax(url='index_page_url')
+@limit_concurrency(generators_limiter)
 def image_to_ascii_generator(request):
     if request.method == 'POST':
         result = ascii_generators.image_to_ascii_generator(request)
-        if isinstance(result, JsonResponse):
+        if isinstance(result, (JsonResponse, StreamingHttpResponse)):
             return result
         return JsonResponse(result, status=200)
     return JsonResponse({}, status=405)
 
 
 @redirect_if_not_ajax(url='index_txt_page_url')
+@limit_concurrency(generators_limiter)
 def text_to_ascii_generator(request):
     if request.method == 'POST':
         results = ascii_generators.text_to_ascii_generator(request)
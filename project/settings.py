@@ -1,5 +1,6 @@
 import atexit
 import os
+import shutil
 import sys
 
 from distutils.util import strtobool
@@ -192,18 +193,76 @@ ROSETTA_SHOW_AT_ADMIN_PANEL = True
 # temporary images folder
 
 TEMPORARY_IMAGES = os.path.join(BASE_DIR, '_images/temporary/')
+TEMPORARY_IMAGES_TTL = int(os.getenv('TEMPORARY_IMAGES_TTL', str(60 * 60)))  # Seconds after the last reference
+# Least recently used temporary images are evicted by janitor over this budget, 0 to disable
+TEMPORARY_IMAGES_MAX_BYTES = int(os.getenv('TEMPORARY_IMAGES_MAX_BYTES', str(2 * 1024 ** 3)))
+# Seconds between janitor runs in every process, 0 to run it only with "clean_temporary_images" command
+TEMPORARY_IMAGES_JANITOR_INTERVAL = int(os.getenv('TEMPORARY_IMAGES_JANITOR_INTERVAL', '0'))
 
 if DEBUG:  # If DEBUG is True, at runserver exit delete all the temporary images
     def clear_temporary_images_folder():
         for file_name in os.listdir(TEMPORARY_IMAGES):
-            if file_name != '.keep':  # Keep the .keep file
-                os.remove(os.path.join(TEMPORARY_IMAGES, file_name))
+            path = os.path.join(TEMPORARY_IMAGES, file_name)
+            if os.path.isdir(path):  # Shard
+                shutil.rmtree(path)
+            elif file_name != '.keep':  # Keep the .keep file
+                os.remove(path)
     atexit.register(clear_temporary_images_folder)
 
+# Fonts of text to ascii generator compiled with "build_font_pack" command,
+# if there's no pack, fonts are compiled from glyph dicts on first use
+FONT_PACK_PATH = os.getenv('FONT_PACK_PATH', os.path.join(BASE_DIR, '_fonts/fonts.pack'))
+# Fonts with glyphs for less than this share of visible characters of text go after the others,
+# fonts without glyphs for any of them are not rendered
+TEXT_FONT_MIN_COVERAGE = float(os.getenv('TEXT_FONT_MIN_COVERAGE', '0.5'))
+
+# IMAGE TO ASCII GENERATORS POOL
+
+# "thread" or "process". Process pool is not limited by GIL, grids are passed to workers through shared memory
+ASCII_GENERATOR_BACKEND = os.getenv('ASCII_GENERATOR_BACKEND', 'thread')
+ASCII_GENERATOR_WORKERS = int(os.getenv('ASCII_GENERATOR_WORKERS', '2'))
+ASCII_GENERATOR_QUEUE_SIZE = int(os.getenv('ASCII_GENERATOR_QUEUE_SIZE', '16'))  # Tasks waiting for a free worker
+# How worker processes are started, forking lazily from threaded server is unsafe, "spawn" where there's no forkserver
+ASCII_GENERATOR_START_METHOD = os.getenv('ASCII_GENERATOR_START_METHOD', 'forkserver')
+# Budget of animated images, frames over it are dropped and the rest is downscaled to fit into pixels
+ANIMATION_MAX_FRAMES = int(os.getenv('ANIMATION_MAX_FRAMES', '300'))
+ANIMATION_MAX_PIXELS = int(os.getenv('ANIMATION_MAX_PIXELS', str(30 * 1000 * 1000)))
+
+# Limits of uploaded images, checked on their headers before decoding. Keys are formats reported by Pillow,
+# missing formats and limits are taken from "default", 0 for no limit
+IMAGE_PROBE_LIMITS = {
+    'default': {
+        'max_bytes': int(os.getenv('IMAGE_PROBE_MAX_BYTES', str(20 * 1024 ** 2))),
+        'max_pixels': int(os.getenv('IMAGE_PROBE_MAX_PIXELS', str(50 * 1000 * 1000))),
+        'max_frames': 64,
+    },
+    'GIF': {'max_pixels': 16 * 1000 * 1000, 'max_frames': 5000},
+    'PNG': {'max_frames': 5000},  # APNG
+    'WEBP': {'max_frames': 5000},
+    'TIFF': {'max_pixels': 25 * 1000 * 1000},
+}
+
+# GENERATORS ADMISSION CONTROL
+
+# Generator requests served at once by one process, others get 503 with Retry-After
+GENERATORS_PROCESS_LIMIT = int(os.getenv('GENERATORS_PROCESS_LIMIT', '8'))
+# Generator requests served at once by all the processes sharing the cache, 0 to disable
+GENERATORS_GLOBAL_LIMIT = int(os.getenv('GENERATORS_GLOBAL_LIMIT', '0'))
+GENERATORS_GLOBAL_COUNTER_TIMEOUT = 60 * 5  # Counts left by killed processes expire with it
+GENERATORS_RETRY_AFTER = int(os.getenv('GENERATORS_RETRY_AFTER', '5'))  # Seconds
+
 # CACHING
 
 CACHE_TIMEOUT_LONG = 600
 CACHE_TIMEOUT_NORMAL = 300
+# Compressed values bigger than this are split into chunks, memcached can't store items over 1 MB
+CACHE_CHUNK_SIZE = 1000 * 1000
+# Identical generator requests are computed once, others wait for result (seconds)
+SINGLE_FLIGHT_LOCK_TIMEOUT = 30
+SINGLE_FLIGHT_WAIT = 20
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+# Text arts of so many recent inputs are kept in memory of every process, in front of the shared cache
+TEXT_CACHE_LOCAL_SIZE = int(os.getenv('TEXT_CACHE_LOCAL_SIZE', '32'))
 
 CACHE_LOCMEM = {
     'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
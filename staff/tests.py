@@ -141,3 +141,28 @@ class TestStaffAdminPageBehavior(TestCase):
         self.client.login(**user)
         response = self.client.get('/staff/admin/')
         self.assertEqual(response.status_code, 200)
+
+
+class TestStaffMetricsView(TestCase):
+    def test_not_staff(self):
+        """
+        Anonymous users and non-staff users should not see metrics
+        """
+        response = self.client.get(reverse('staff_metrics_url'))
+        self.assertEqual(response.status_code, 404)
+        user = _create_normal_user()
+        self.client.login(**user)
+        response = self.client.get(reverse('staff_metrics_url'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_staff(self):
+        """
+        Staff should get json with metrics
+        """
+        user = _create_staff_user('admin', 'admin')
+        self.client.login(**user)
+        response = self.client.get(reverse('staff_metrics_url'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('generator_pool', response.json())
+        self.assertIn('admission', response.json())
+        self.assertIn('image_probe', response.json())
@@ -2,12 +2,13 @@ from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
-from staff.views import staff_authentication, staff_logout
+from staff.views import staff_authentication, staff_logout, staff_metrics
 
 
 urlpatterns = [
     path('authentication/', staff_authentication, name='staff_authentication_url'),
     path('logout/', staff_logout, name='staff_logout_url'),
+    path('metrics/', staff_metrics, name='staff_metrics_url'),
 ]
 
 # If we are in production, turn on admin page by /staff/admin/ instead of just /admin/
@@ -1,7 +1,11 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
+from django.http import JsonResponse, Http404
 
 from staff.forms import StaffAuthenticationForm
+from app.ascii_generators import image_probe, temporary_images, workers
+from app import caching
+from app.decorators import generators_limiter
 
 
 #  Staff pages is scuffed on purpose (for now)
@@ -35,3 +39,15 @@ def staff_logout(request):
     if request.user.is_authenticated and request.user.is_staff:
         logout(request)
     return redirect('index_page_url')
+
+
+def staff_metrics(request):
+    if not (request.user.is_authenticated and request.user.is_staff):
+        raise Http404
+    return JsonResponse({
+        'generator_pool': workers.get_metrics(),
+        'admission': generators_limiter.metrics(),
+        'cache': caching.get_metrics(),
+        'image_probe': image_probe.get_metrics(),
+        'temporary_images_janitor': temporary_images.get_janitor_report(),
+    })